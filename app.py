@@ -1,35 +1,139 @@
-from fastapi import FastAPI, Request, HTTPException, Form, BackgroundTasks, File, UploadFile, Response, Cookie
+from fastapi import FastAPI, Request, HTTPException, Form, File, UploadFile, Response, Depends
 from starlette.responses import RedirectResponse
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 import uvicorn
 import yt_dlp
-import json
 import os
 from datetime import datetime
 import aiofiles
 import shutil
-from auth import get_current_user, authenticate_user, register_user
+import hashlib
+import re
+import config
+from auth import get_current_user, get_optional_user, get_admin_user, authenticate_user, register_user, create_access_token, load_users, save_users, refresh_users
+from video_store import store, video_folder, run_compactor
+from view_counter import ViewCounter, run_view_flusher
+from stream_cache import StreamCache
+from worker_pool import PoolSaturated, extract_pool, image_pool, io_pool
+from ingest_queue import IngestQueue, RetryableJobError
+from locks import LeaderLock, run_leader_election
+from thumbnails import adopt_legacy_thumbnails, thumbnail_cache
+from telegram_stream import MediaStreamer, parse_range
+from media_files import MediaFileResponse, MediaFiles, asset_url
+from fragment_cache import FragmentCache, FragmentCacheExtension
+from thumbnail_derivatives import (GRID_SIZES, FORMATS, available_widths, thumbnail_derivatives,
+                                   thumbnail_digest, thumbnail_srcset, thumbnail_url)
+from transcoder import run_transcode_job, submit_transcode, transcode_queue
 import asyncio
 try:
-    from telegram_client import fetch_videos_from_channel
+    from telegram_client import get_video_stream, telegram
+    from sync_worker import run_sync_job, scheduler as sync_scheduler, submit_sync, sync_queue
     TELEGRAM_AVAILABLE = True
 except ImportError:
     TELEGRAM_AVAILABLE = False
 
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Thumbnails are named after their content hash, so browsers may keep them forever
+app.mount("/static", MediaFiles(directory="static", immutable_pattern=r"thumbnails/[0-9a-f]{32}\.\w+$"), name="static")
 
-# Only mount videos directory if it exists
-import os
-if os.path.exists("videos"):
-    app.mount("/videos", StaticFiles(directory="videos"), name="videos")
+# HLS renditions are written under videos/, so it always exists now
+os.makedirs(config.HLS_DIR, exist_ok=True)
+app.mount("/videos", MediaFiles(directory="videos"), name="videos")
 
 templates = Jinja2Templates(directory="templates")
+templates.env.globals.update(asset_url=asset_url, thumbnail_srcset=thumbnail_srcset, thumbnail_url=thumbnail_url,
+                             thumbnail_sizes=GRID_SIZES, thumbnail_widths=available_widths())
+# Video grids and folder lists are reused until the user's catalog changes
+templates.env.add_extension(FragmentCacheExtension)
+templates.env.fragment_cache = FragmentCache(store.data_version)
+
+# Video and folder catalog, loaded once and kept in memory
+store.load()
+view_counter = ViewCounter(store)
+stream_cache = StreamCache()
+ingest_queue = IngestQueue()
+ingest_queue.load()
+transcode_queue.load()
+if TELEGRAM_AVAILABLE:
+    sync_queue.load()
+media_streamer = MediaStreamer(get_video_stream) if TELEGRAM_AVAILABLE else None
+# Only one worker process runs the singleton background tasks
+leader = LeaderLock()
+
+async def sync_with_other_workers(interval: float = config.STORE_SYNC_INTERVAL):
+    """Background task picking up catalog and user changes saved by other worker processes"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await io_pool.run(store.sync)
+            refresh_users()
+        except PoolSaturated:
+            pass
+        except Exception as e:
+            print(f"Error syncing with other workers: {e}")
 
-VIDEO_DB = "video_db.json"
-FOLDER_DB = "folder_db.json"
+async def start_telegram_client():
+    """Connect the shared Telegram client up front; failures are retried on first use"""
+    try:
+        await telegram.start()
+    except Exception as e:
+        print(f"Telegram client not started: {e}")
+
+async def adopt_thumbnails():
+    try:
+        await adopt_legacy_thumbnails(store)
+    except Exception as e:
+        print(f"Error moving legacy thumbnails: {e}")
+
+def start_leader_tasks():
+    app.state.compactor = asyncio.create_task(run_compactor(store))
+    app.state.thumbnail_adoption = asyncio.create_task(adopt_thumbnails())
+    ingest_queue.start(run_ingest_job)
+    transcode_queue.start(run_transcode_job)
+    if TELEGRAM_AVAILABLE:
+        sync_queue.start(run_sync_job)
+        if config.CHANNELS:
+            sync_scheduler.start()
+
+@app.on_event("startup")
+async def start_store_compactor():
+    # Fork the image processes before any pool thread is busy
+    image_pool.warm_up()
+    app.state.view_flusher = asyncio.create_task(run_view_flusher(view_counter))
+    app.state.worker_sync = asyncio.create_task(sync_with_other_workers())
+    app.state.leader_election = asyncio.create_task(run_leader_election(leader, start_leader_tasks))
+    if TELEGRAM_AVAILABLE and (config.CHANNELS or config.BOT_TOKEN):
+        app.state.telegram_start = asyncio.create_task(start_telegram_client())
+
+@app.on_event("shutdown")
+async def stop_store_compactor():
+    ingest_queue.stop()
+    transcode_queue.stop()
+    app.state.leader_election.cancel()
+    app.state.worker_sync.cancel()
+    app.state.view_flusher.cancel()
+    view_counter.flush()
+    if TELEGRAM_AVAILABLE:
+        sync_queue.stop()
+        sync_scheduler.stop()
+    if leader.is_leader:
+        app.state.compactor.cancel()
+        store.compact()
+        leader.release()
+    store.close()
+    await thumbnail_cache.close()
+    if TELEGRAM_AVAILABLE:
+        if hasattr(app.state, "telegram_start"):
+            app.state.telegram_start.cancel()
+        await telegram.stop()
+    extract_pool.shutdown()
+    io_pool.shutdown()
+    image_pool.shutdown()
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request: Request, exc: PoolSaturated):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
 
 # Authentication routes
 @app.get("/login", response_class=HTMLResponse)
@@ -38,14 +142,13 @@ async def login_page(request: Request, error: str = None):
 
 @app.post("/login")
 async def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    user = authenticate_user(username, password)
+    user = await io_pool.run(authenticate_user, username, password)
     if not user:
         return templates.TemplateResponse("login.html", {
             "request": request,
             "error": "Invalid username or password"
         })
 
-    from auth import create_access_token
     token = create_access_token({"sub": username})
 
     # Redirect admin users to admin panel, others to home
@@ -77,7 +180,7 @@ async def register(
         })
 
     try:
-        user = register_user(username, email, password)
+        user = await io_pool.run(register_user, username, email, password)
         return templates.TemplateResponse("register.html", {
             "request": request,
             "success": "Account created successfully! You can now login."
@@ -94,46 +197,8 @@ async def logout(response: Response):
     response.delete_cookie("auth_token")
     return response
 
-def load_db():
-    try:
-        with open(VIDEO_DB, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-def save_db(db):
-    with open(VIDEO_DB, 'w') as f:
-        json.dump(db, f, indent=2)
-
-def load_folder_db():
-    try:
-        with open(FOLDER_DB, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-def save_folder_db(db):
-    with open(FOLDER_DB, 'w') as f:
-        json.dump(db, f, indent=2)
-
-def build_folder_hierarchy():
-    """Build hierarchical folder structure from videos and folders"""
-    db = load_db()
-    folder_db = load_folder_db()
-
-    # Get all unique folder paths
-    folders = {}
-    for video in db.values():
-        folder_path = video.get('folder_path', video.get('folder_name', ''))
-        if folder_path:
-            folders[folder_path] = folders.get(folder_path, 0) + 1
-
-    # Add folders from folder_db
-    for folder_name, folder_info in folder_db.items():
-        if folder_name not in folders:
-            folders[folder_name] = 0
-
-    # Build hierarchy
+def nest_folder_counts(folders):
+    """Turn a {folder_path: video_count} map into the nested hierarchy dict"""
     hierarchy = {}
     for folder_path, count in folders.items():
         parts = folder_path.split('/')
@@ -151,69 +216,35 @@ def build_folder_hierarchy():
 
     return hierarchy
 
-def build_user_folder_hierarchy(username):
-    """Build folder hierarchy for a specific user"""
-    db = load_db()
-    folder_db = load_folder_db()
-
-    # Get user's folder paths
+def build_folder_hierarchy():
+    """Build hierarchical folder structure from videos and folders"""
+    # Get all unique folder paths
     folders = {}
-    for video in db.values():
-        if video.get('user_id') == username:
-            folder_path = video.get('folder_path', video.get('folder_name', ''))
-            if folder_path:
-                folders[folder_path] = folders.get(folder_path, 0) + 1
-
-    # Add user's folders from folder_db
-    for folder_name, folder_info in folder_db.items():
-        if folder_info.get('user_id') == username:
-            if folder_name not in folders:
-                folders[folder_name] = 0
-
-    # Build hierarchy
-    hierarchy = {}
-    for folder_path, count in folders.items():
-        parts = folder_path.split('/')
-        current = hierarchy
-        for part in parts:
-            if part not in current:
-                current[part] = {'count': 0, 'subfolders': {}}
-            current = current[part]['subfolders']
-        # Set count on the deepest level
-        if parts:
-            current = hierarchy
-            for part in parts[:-1]:
-                current = current[part]['subfolders']
-            current[parts[-1]]['count'] = count
+    for video in store.all_videos():
+        folder_path = video_folder(video)
+        if folder_path:
+            folders[folder_path] = folders.get(folder_path, 0) + 1
 
-    return hierarchy
+    # Add folders from folder_db
+    for folder_name in store.export_folders():
+        if folder_name not in folders:
+            folders[folder_name] = 0
+
+    return nest_folder_counts(folders)
+
+def build_user_folder_hierarchy(username):
+    """Build folder hierarchy for a specific user"""
+    return store.folder_hierarchy(username)
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request, auth_token: str = Cookie(None)):
+async def home(request: Request, user: dict = Depends(get_optional_user)):
     # Check if user is authenticated
-    if not auth_token:
-        return RedirectResponse("/login", status_code=302)
-
-    try:
-        from auth import verify_token
-        username = verify_token(auth_token)
-        if not username:
-            return RedirectResponse("/login", status_code=302)
-
-        from auth import load_users
-        users = load_users()
-        if username not in users:
-            return RedirectResponse("/login", status_code=302)
-
-        user = users[username]
-    except Exception:
+    if not user:
         return RedirectResponse("/login", status_code=302)
 
-    db = load_db()
-
-    # Filter videos by current user
-    user_videos = [video for video in db.values() if video.get('user_id') == user['username']]
-    user_videos.sort(key=lambda x: x.get('added_time', ''), reverse=True)
+    # First page of the user's videos, newest first; the rest load on scroll
+    user_videos, next_cursor = store.page_for_user(user['username'], config.PAGE_SIZE)
+    user_videos = view_counter.with_views(user_videos)
 
     # Build user-specific folder hierarchy
     folder_hierarchy = build_user_folder_hierarchy(user['username'])
@@ -222,219 +253,187 @@ async def home(request: Request, auth_token: str = Cookie(None)):
         "request": request,
         "folder_hierarchy": folder_hierarchy,
         "videos": user_videos,
+        "next_cursor": next_cursor,
         "current_user": user
     })
 
 @app.get("/folder/{folder_path:path}", response_class=HTMLResponse)
-async def folder_page(request: Request, folder_path: str, auth_token: str = Cookie(None)):
+async def folder_page(request: Request, folder_path: str, recursive: bool = True, user: dict = Depends(get_optional_user)):
     # Check authentication
-    if not auth_token:
-        return RedirectResponse("/login", status_code=302)
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            return RedirectResponse("/login", status_code=302)
-        user = users[username]
-    except Exception:
+    if not user:
         return RedirectResponse("/login", status_code=302)
+    username = user['username']
 
-    db = load_db()
-    folder_db = load_folder_db()
-
-    # Find user's videos in this folder and subfolders
-    videos = []
-    for video in db.values():
-        if video.get('user_id') == username:
-            video_folder = video.get('folder_path', video.get('folder_name', ''))
-            if video_folder == folder_path or video_folder.startswith(folder_path + '/'):
-                videos.append(video)
+    # First page of the user's videos in this folder (and its subfolders unless recursive=false)
+    videos, next_cursor = store.page_for_user(username, config.PAGE_SIZE, folder=folder_path, recursive=recursive)
 
     # Get user's subfolders
-    subfolders = {}
-    for folder_name, folder_info in folder_db.items():
-        if (folder_info.get('user_id') == username and
-            folder_name.startswith(folder_path + '/') and
-            folder_name.count('/') == folder_path.count('/') + 1):
-            subfolder_name = folder_name.split('/')[-1]
-            subfolders[subfolder_name] = folder_name
+    subfolders = store.subfolders(username, folder_path)
 
     return templates.TemplateResponse("folder.html", {
         "request": request,
         "folder_path": folder_path,
         "folder_name": folder_path.split('/')[-1],
-        "videos": videos,
+        "videos": view_counter.with_views(videos),
+        "next_cursor": next_cursor,
+        "recursive": recursive,
         "subfolders": subfolders,
         "current_user": user
     })
 
+def can_view(video: dict, username: str) -> bool:
+    """Users see their own videos; synced channel videos have no owner and are shown to everyone"""
+    return video.get('source_type') == 'telegram' or video.get('user_id') == username
+
 @app.get("/watch/{video_id}", response_class=HTMLResponse)
-async def watch(request: Request, video_id: str, auth_token: str = Cookie(None)):
+async def watch(request: Request, video_id: str, user: dict = Depends(get_optional_user)):
     # Check authentication
-    if not auth_token:
-        return RedirectResponse("/login", status_code=302)
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            return RedirectResponse("/login", status_code=302)
-        user = users[username]
-    except Exception:
+    if not user:
         return RedirectResponse("/login", status_code=302)
+    username = user['username']
 
-    db = load_db()
-    video = db.get(video_id)
+    video = store.get_video(video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    # Check if video belongs to user
-    if video.get('user_id') != username:
+    if not can_view(video, username):
         raise HTTPException(status_code=403, detail="Access denied")
 
-    # Increment views
-    video['views_count'] = video.get('views_count', 0) + 1
-    save_db(db)
+    # Increment views (buffered, written to the store in batches)
+    video = dict(video, views_count=view_counter.increment(video_id))
+    if view_counter.flush_due:
+        try:
+            await io_pool.run(view_counter.flush)
+        except PoolSaturated:
+            pass  # The periodic flusher will write them
     return templates.TemplateResponse("watch.html", {"request": request, "video": video, "current_user": user})
 
 @app.post("/add_video")
 async def add_video(
-    background_tasks: BackgroundTasks,
     url: str = Form(...),
     folder_path: str = Form(None),
     new_folder: str = Form(None),
-    auth_token: str = Cookie(None)
+    user: dict = Depends(get_current_user)
 ):
-    # Verify user authentication
-    if not auth_token:
-        return {"error": "Authentication required"}, 401
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            return {"error": "User not found"}, 401
-        user = users[username]
-    except Exception:
-        return {"error": "Invalid authentication"}, 401
+    username = user['username']
 
     # Use new_folder if provided, otherwise use folder_path
     actual_folder = new_folder if new_folder else folder_path
     if not actual_folder:
         return {"error": "Folder path is required"}, 400
 
-    background_tasks.add_task(process_video, url, actual_folder, username)
-    return {"message": "Video processing started"}
+    job = await ingest_queue.submit("youtube", username, url, folder=actual_folder)
+    return {"message": "Video processing started", "job_id": job['job_id'], "status": job['status']}
 
 @app.get("/api/folders")
-async def get_folders(auth_token: str = Cookie(None)):
-    # Check authentication
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+async def get_folders(user: dict = Depends(get_current_user)):
+    username = user['username']
+
+    return {"folders": store.folder_list(username)}
+
+def extract_stream(url: str, fmt: str = '18'):
+    """Resolve a direct stream URL with yt-dlp (blocking)"""
+    # Try to get direct MP4/WebM URL (18 is MP4 format on YouTube)
+    ydl_opts = {
+        'format': fmt,
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 30,
+    }
 
     try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            raise HTTPException(status_code=401, detail="User not found")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
-    folder_hierarchy = build_user_folder_hierarchy(username)
-
-    # Flatten hierarchy for backward compatibility
-    def flatten_hierarchy(hierarchy, prefix=""):
-        folders = []
-        for name, data in hierarchy.items():
-            full_path = f"{prefix}/{name}" if prefix else name
-            folders.append({
-                'name': full_path,
-                'display_name': name,
-                'count': data['count'],
-                'path': full_path,
-                'has_subfolders': bool(data['subfolders'])
-            })
-            # Recursively add subfolders
-            folders.extend(flatten_hierarchy(data['subfolders'], full_path))
-        return folders
-
-    folders = flatten_hierarchy(folder_hierarchy)
-    return {"folders": folders}
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            stream_url = info.get('url')
+
+            if stream_url:
+                return {
+                    "stream_url": stream_url,
+                    "title": info.get('title'),
+                    "duration": info.get('duration', 0),
+                    "format": "mp4" if fmt == '18' else fmt
+                }
+    except:
+        pass
+
+    # Fallback - try best format
+    ydl_opts2 = {
+        'format': 'best',
+        'quiet': True,
+        'no_warnings': True,
+    }
+
+    with yt_dlp.YoutubeDL(ydl_opts2) as ydl:
+        info = ydl.extract_info(url, download=False)
+        stream_url = info.get('url')
+
+        if stream_url:
+            return {
+                "stream_url": stream_url,
+                "title": info.get('title'),
+                "duration": info.get('duration', 0),
+                "format": "unknown"
+            }
+
+    return None
+
+@app.get("/api/videos")
+async def list_videos(
+    cursor: str = None,
+    limit: int = config.PAGE_SIZE,
+    folder: str = None,
+    recursive: bool = True,
+    user: dict = Depends(get_current_user)
+):
+    """Page through the user's videos, newest first; pass next_cursor back for the next page"""
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+    try:
+        videos, next_cursor = store.page_for_user(user['username'], limit, cursor, folder, recursive)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"videos": view_counter.with_views(videos), "next_cursor": next_cursor}
+
+@app.get("/api/search")
+async def search_videos(
+    q: str,
+    limit: int = config.PAGE_SIZE,
+    folder: str = None,
+    user: dict = Depends(get_current_user)
+):
+    """Search the user's videos by title, description, category and folder name"""
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+    videos, total = store.search(user['username'], q, limit, folder)
+    return {"videos": view_counter.with_views(videos), "total": total}
 
 @app.get("/api/stream/{video_id}")
-async def get_stream(video_id: str, auth_token: str = Cookie(None)):
+async def get_stream(video_id: str, format: str = '18', user: dict = Depends(get_current_user)):
     """Get streaming URL for a video"""
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+    username = user['username']
 
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            raise HTTPException(status_code=401, detail="User not found")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
-    db = load_db()
-    video = db.get(video_id)
+    video = store.get_video(video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    # Check if video belongs to user
-    if video.get('user_id') != username:
+    if not can_view(video, username):
         raise HTTPException(status_code=403, detail="Access denied")
-    
+
+    if video.get('source_type') == 'telegram':
+        # Played through the streaming proxy (or as HLS once transcoded)
+        if video.get('hls_url'):
+            return {"stream_url": video['hls_url'], "title": video.get('title'), "format": "hls",
+                    "fallback_url": video['source_url']}
+        return {"stream_url": video['source_url'], "title": video.get('title'), "format": "telegram"}
+
     try:
-        # Extract stream URL using yt-dlp
+        # Extract stream URL using yt-dlp, sharing cached and in-flight results
         url = video['source_url']
-        
-        # Try to get direct MP4/WebM URL
-        ydl_opts = {
-            'format': '18',  # 18 is MP4 format on YouTube
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 30,
-        }
-        
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                stream_url = info.get('url')
-                
-                if stream_url:
-                    return {
-                        "stream_url": stream_url,
-                        "title": info.get('title', video.get('title')),
-                        "duration": info.get('duration', 0),
-                        "format": "mp4"
-                    }
-        except:
-            pass
-        
-        # Fallback - try best format
-        ydl_opts2 = {
-            'format': 'best',
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts2) as ydl:
-            info = ydl.extract_info(url, download=False)
-            stream_url = info.get('url')
-            
-            if stream_url:
-                return {
-                    "stream_url": stream_url,
-                    "title": info.get('title', video.get('title')),
-                    "duration": info.get('duration', 0),
-                    "format": "unknown"
-                }
+        result = await stream_cache.get(
+            (video_id, format),
+            lambda: extract_pool.run(extract_stream, url, format)
+        )
+
+        if result:
+            return dict(result, title=result.get('title') or video.get('title'))
         
         # If we still don't have URL, use fallback embed
         return {
@@ -444,6 +443,8 @@ async def get_stream(video_id: str, auth_token: str = Cookie(None)):
             "title": video.get('title')
         }
         
+    except PoolSaturated:
+        raise
     except Exception as e:
         print(f"Error extracting stream: {e}")
         # Return fallback with embed URL
@@ -456,36 +457,22 @@ async def get_stream(video_id: str, auth_token: str = Cookie(None)):
 
 
 @app.post("/api/rename_folder")
-async def rename_folder(old_name: str = Form(...), new_name: str = Form(...), auth_token: str = Cookie(None)):
+async def rename_folder(old_name: str = Form(...), new_name: str = Form(...), user: dict = Depends(get_current_user)):
     """Rename a folder and update all videos in it"""
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            raise HTTPException(status_code=401, detail="User not found")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
-    db = load_db()
-    folder_db = load_folder_db()
+    username = user['username']
 
     # Update all user's videos with the old folder name
-    for video in db.values():
-        if video.get('user_id') == username and video.get('folder_name') == old_name:
-            video['folder_name'] = new_name
+    renamed = {}
+    for video in store.videos_for_user(username):
+        if video.get('folder_name') == old_name:
+            renamed[video['video_id']] = dict(video, folder_name=new_name)
+    await io_pool.run(store.put_videos, renamed)
 
     # Update folder in folder_db if it belongs to user
-    if old_name in folder_db and folder_db[old_name].get('user_id') == username:
-        folder_info = folder_db[old_name]
-        folder_info['name'] = new_name
-        folder_info['path'] = new_name
-        folder_db[new_name] = folder_info
-        del folder_db[old_name]
-        save_folder_db(folder_db)
+    folder_info = store.get_folder(old_name)
+    if folder_info and folder_info.get('user_id') == username:
+        folder_info = dict(folder_info, name=new_name, path=new_name)
+        await io_pool.run(store.rename_folder, old_name, new_name, folder_info)
 
     # Rename physical folder
     old_path = os.path.join("videos", username, old_name)
@@ -494,11 +481,28 @@ async def rename_folder(old_name: str = Form(...), new_name: str = Form(...), au
     if os.path.exists(old_path):
         os.rename(old_path, new_path)
 
-    save_db(db)
     return {"message": f"Folder renamed from {old_name} to {new_name}"}
 
 
 
+@app.get("/thumbs/{width}/{name}")
+async def resized_thumbnail(width: int, name: str):
+    """A stored thumbnail scaled down to one of THUMBNAIL_WIDTHS, as WebP or JPEG"""
+    digest = thumbnail_digest(name)
+    ext = name.rpartition('.')[2]
+    if digest is None or ext not in FORMATS or width not in config.THUMBNAIL_WIDTHS:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    try:
+        path = await thumbnail_derivatives.get(digest, width, ext)
+    except PoolSaturated:
+        path = None  # Too busy to resize now: the original will do
+    if path is not None:
+        return MediaFileResponse(path, os.stat(path), immutable=True)
+    original = thumbnail_derivatives.original(digest)
+    if original is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return MediaFileResponse(original, os.stat(original))
+
 @app.get("/api/telegram/channels")
 async def get_telegram_channels():
     """Get list of configured Telegram channels"""
@@ -510,184 +514,290 @@ async def get_telegram_channels():
     return {"channels": channels}
 
 @app.get("/api/telegram/sync/{channel}")
-async def sync_telegram_channel(channel: str, background_tasks: BackgroundTasks):
-    """Sync videos from a Telegram channel"""
+async def sync_telegram_channel(channel: str, admin: dict = Depends(get_admin_user)):
+    """Have the leader sync a configured Telegram channel now, unless it is already syncing"""
     if not TELEGRAM_AVAILABLE:
         raise HTTPException(status_code=400, detail="Telegram client not available")
-    
-    try:
-        # Queue background task
-        background_tasks.add_task(fetch_and_store_telegram_videos, channel)
-        return {"message": f"Syncing channel: {channel}"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    channel = channel.strip()
+    if channel not in sync_scheduler.channels:
+        raise HTTPException(status_code=404, detail=f"Not a configured channel: {channel}")
+
+    job = await submit_sync(channel, admin['username'])
+    return {"message": f"Syncing channel: {channel}", "job_id": job['job_id'], "status": job['status']}
+
+@app.post("/api/admin/telegram/resync")
+async def resync_telegram_channels(admin: dict = Depends(get_admin_user)):
+    """Refetch every channel from its first message, repairing the Telegram videos in the store"""
+    if not TELEGRAM_AVAILABLE:
+        raise HTTPException(status_code=400, detail="Telegram client not available")
+    jobs = [await submit_sync(channel, admin['username'], full=True) for channel in sync_scheduler.channels]
+    return {"message": f"Full resync requested for {len(jobs)} channels",
+            "jobs": {job['params']['channel']: job['job_id'] for job in jobs}}
 
 @app.get("/api/telegram/videos")
 async def get_telegram_videos():
-    """Get all Telegram videos from cache"""
+    """Get all Telegram videos synced into the catalog"""
+    return {video['video_id']: video for video in store.videos_by_source('telegram')}
+
+def find_telegram_media(unique_id: str = None, file_id: str = None):
+    """Catalog record of a Telegram video, by unique ID or file ID"""
+    video = store.get_video(unique_id) if unique_id else store.video_by_file_id(file_id)
+    return video if video and video.get('source_type') == 'telegram' else None
+
+def stream_telegram_media(request: Request, video: dict):
+    """Stream a Telegram video, honouring a Range header so players can seek"""
+    file_id = video.get('file_id')
+    if not file_id:
+        raise HTTPException(status_code=404, detail="Video has no Telegram file")
+    media_type = video.get('mime_type') or 'video/mp4'
+    size = video.get('file_size') or 0
+    if not size:
+        # Unknown size: no ranges, just the whole file
+        return StreamingResponse(media_streamer.fetch(file_id, 0, 0), media_type=media_type)
+
     try:
-        import config
-        cache_file = config.VIDEO_CACHE_FILE
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {}
+        byte_range = parse_range(request.headers.get('range'), size)
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(end - start + 1)}
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(media_streamer.iter_range(file_id, start, end),
+                             status_code=206 if byte_range else 200,
+                             media_type=media_type, headers=headers)
+
+@app.get("/api/telegram/download/{unique_id}")
+async def telegram_download(request: Request, unique_id: str, user: dict = Depends(get_current_user)):
+    """Stream a synced Telegram video by its unique ID"""
+    if not TELEGRAM_AVAILABLE:
+        raise HTTPException(status_code=400, detail="Telegram client not available")
+    video = find_telegram_media(unique_id=unique_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    return stream_telegram_media(request, video)
 
-async def fetch_and_store_telegram_videos(channel: str):
-    """Background task to fetch and store Telegram videos"""
+@app.get("/stream/{file_id}")
+async def telegram_stream(request: Request, file_id: str, user: dict = Depends(get_current_user)):
+    """Stream a Telegram video by its file ID (the stream_url of cached channel videos)"""
     if not TELEGRAM_AVAILABLE:
-        return
-    
-    try:
-        videos = await fetch_videos_from_channel(channel)
-        db = load_db()
-        
-        for video in videos:
-            unique_id = video.get('unique_video_id')
-            if unique_id and unique_id not in db:
-                # Convert Telegram video to database format
-                db[unique_id] = {
-                    'video_id': unique_id,
-                    'title': video.get('title', 'Telegram Video'),
-                    'source_url': f"/api/telegram/download/{unique_id}",
-                    'folder_name': f"📱 {video.get('channel_name', 'Telegram')}",
-                    'embed_url': f"/watch/{unique_id}",
-                    'thumbnail_path': video.get('thumbnail_path', ''),
-                    'duration': video.get('duration', 0),
-                    'file_size': video.get('file_size', 0),
-                    'added_time': datetime.now().isoformat(),
-                    'views_count': 0,
-                    'source_type': 'telegram',
-                    'file_id': video.get('file_id', ''),
-                    'message_id': video.get('message_id'),
-                    'channel_id': video.get('channel_id')
-                }
-        
-        save_db(db)
-        print(f"Synced {len(videos)} videos from {channel}")
-    except Exception as e:
-        print(f"Error syncing Telegram channel: {e}")
+        raise HTTPException(status_code=400, detail="Telegram client not available")
+    video = find_telegram_media(file_id=file_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    return stream_telegram_media(request, video)
+
+class ThumbnailDownloadError(RetryableJobError):
+    """The thumbnail could not be downloaded; the ingestion job will retry"""
+
+# Extract video_id from URL - YouTube IDs are exactly 11 alphanumeric/dash characters
+YOUTUBE_ID_PATTERNS = [
+    r'youtube\.com/watch\?v=([a-zA-Z0-9_-]{11})',
+    r'youtu\.be/([a-zA-Z0-9_-]{11})',
+    r'youtube\.com/embed/([a-zA-Z0-9_-]{11})',
+    r'youtube\.com/live/([a-zA-Z0-9_-]{11})',
+    r'youtube\.com/watch\?v=([a-zA-Z0-9_-]+)',  # Allow longer IDs as fallback
+    r'youtu\.be/([a-zA-Z0-9_-]+)',  # Allow longer IDs as fallback
+]
+
+def extract_video_id(url: str):
+    """YouTube video ID of a URL, or None if no pattern matches"""
+    for pattern in YOUTUBE_ID_PATTERNS:
+        match = re.search(pattern, url)
+        if match:
+            extracted_id = match.group(1)
+            # Validate: YouTube video IDs should be 11 characters
+            if len(extracted_id) == 11:
+                return extracted_id.strip()
+            # If not 11 chars, it might be a live video or playlist - try anyway
+            elif len(extracted_id) > 0:
+                return extracted_id.strip()
+    return None
+
+async def download_thumbnail(video_id: str, allow_missing_thumbnail: bool = True):
+    """Fetch a video's thumbnail into the thumbnail cache and return its path.
+
+    If no variant can be fetched, returns '' (templates then hotlink
+    YouTube's own thumbnail) when allow_missing_thumbnail is set, otherwise
+    raises ThumbnailDownloadError.
+    """
+    thumbnail_path = await thumbnail_cache.fetch_youtube(video_id)
+    if thumbnail_path is None:
+        if not allow_missing_thumbnail:
+            raise ThumbnailDownloadError(f"Thumbnail download failed for {video_id}")
+        return ''
+    return thumbnail_path
+
+def make_video_folder(folder_name: str, username: str = None):
+    """Create the physical folder for a user's video folder"""
+    if username:
+        folder_path = os.path.join("videos", username, folder_name)
+    else:
+        folder_path = os.path.join("videos", folder_name)
+    os.makedirs(folder_path, exist_ok=True)
+
+def youtube_video_record(video_id: str, url: str, folder_name: str, username: str, thumbnail_path: str):
+    # Use basic info (yt-dlp causing issues)
+    return {
+        'video_id': video_id,
+        'user_id': username,  # Associate with user
+        'title': f"YouTube Video {video_id}",
+        'source_url': url,
+        'folder_path': folder_name,  # Changed from folder_name to folder_path
+        'folder_name': folder_name.split('/')[-1],  # Keep for backward compatibility
+        'embed_url': f"https://www.youtube.com/embed/{video_id}",
+        'thumbnail_path': thumbnail_path,
+        'duration': 0,
+        'file_size': 0,  # Not downloaded
+        'added_time': datetime.now().isoformat(),
+        'views_count': 0
+    }
 
-async def process_video(url: str, folder_name: str, username: str = None):
-    try:
-        # Extract video_id from URL - YouTube IDs are exactly 11 alphanumeric/dash characters
-        import re
-        # Try different URL patterns
-        patterns = [
-            r'youtube\.com/watch\?v=([a-zA-Z0-9_-]{11})',
-            r'youtu\.be/([a-zA-Z0-9_-]{11})',
-            r'youtube\.com/embed/([a-zA-Z0-9_-]{11})',
-            r'youtube\.com/live/([a-zA-Z0-9_-]{11})',
-            r'youtube\.com/watch\?v=([a-zA-Z0-9_-]+)',  # Allow longer IDs as fallback
-            r'youtu\.be/([a-zA-Z0-9_-]+)',  # Allow longer IDs as fallback
-        ]
-        
-        video_id = None
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                extracted_id = match.group(1)
-                # Validate: YouTube video IDs should be 11 characters
-                if len(extracted_id) == 11:
-                    video_id = extracted_id
-                    break
-                # If not 11 chars, it might be a live video or playlist - try anyway
-                elif len(extracted_id) > 0:
-                    video_id = extracted_id
-                    break
-        
+async def process_video(url: str, folder_name: str, username: str = None, allow_missing_thumbnail: bool = True):
+    """Add a YouTube video to the store and return {'video_id', 'created'}.
+
+    Raises ValueError for URLs without a recognisable video ID. When the
+    thumbnail download fails, the video is stored without one if
+    allow_missing_thumbnail is set, otherwise ThumbnailDownloadError is raised.
+    """
+    video_id = extract_video_id(url)
+    if not video_id:
+        raise ValueError(f"Invalid YouTube URL: {url}")
+
+    # Check if exists
+    if store.has_video(video_id):
+        return {"video_id": video_id, "created": False}
+
+    make_video_folder(folder_name, username)
+    thumbnail_path = await download_thumbnail(video_id, allow_missing_thumbnail)
+
+    # Save to db
+    record = youtube_video_record(video_id, url, folder_name, username, thumbnail_path)
+    await io_pool.run(store.put_video, video_id, record)
+    print(f"Video added: {record['title']}")
+    return {"video_id": video_id, "created": True}
+
+def extract_playlist_urls(playlist_url: str):
+    """Video URLs of a YouTube playlist, without resolving each video (blocking)"""
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 30,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(playlist_url, download=False)
+    urls = []
+    for entry in info.get('entries') or []:
+        if entry and entry.get('id'):
+            urls.append(f"https://www.youtube.com/watch?v={entry['id']}")
+    return urls
+
+async def import_videos(urls, folder_name: str, username: str, playlist_url: str = None):
+    """Add many YouTube videos at once, committing all new records in one store write"""
+    if playlist_url:
+        urls = list(urls) + await extract_pool.run(extract_playlist_urls, playlist_url)
+
+    new_urls = {}
+    existing = []
+    invalid = []
+    for url in urls:
+        video_id = extract_video_id(url)
         if not video_id:
-            print(f"Invalid YouTube URL: {url}")
-            return
-        
-        # Clean video_id - ensure no special characters except dash and underscore
-        video_id = video_id.strip()
-
-        # Check if exists
-        db = load_db()
-        if video_id in db:
-            print("Video already exists")
-            return
-
-        # Create folder if it doesn't exist
-        if username:
-            folder_path = os.path.join("videos", username, folder_name)
-        else:
-            folder_path = os.path.join("videos", folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-
-        # Use embed URL for YouTube
-        embed_url = f"https://www.youtube.com/embed/{video_id}"
-
-        # Use basic info (yt-dlp causing issues)
-        title = f"YouTube Video {video_id}"
-        duration = 0
-        thumbnail_url = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-
-        # Download thumbnail
-        thumbnail_path = os.path.join("static", "thumbnails", f"{video_id}.jpg")
-        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
-        try:
-            import urllib.request
-            urllib.request.urlretrieve(thumbnail_url, thumbnail_path)
-        except:
-            # Create a placeholder
-            with open(thumbnail_path, 'wb') as f:
-                f.write(b'')  # Empty file
-
-        # Save to db
-        db[video_id] = {
-            'video_id': video_id,
-            'user_id': username,  # Associate with user
-            'title': title,
-            'source_url': url,
-            'folder_path': folder_name,  # Changed from folder_name to folder_path
-            'folder_name': folder_name.split('/')[-1],  # Keep for backward compatibility
-            'embed_url': embed_url,
-            'thumbnail_path': thumbnail_path,
-            'duration': duration,
-            'file_size': 0,  # Not downloaded
-            'added_time': datetime.now().isoformat(),
-            'views_count': 0
-        }
-        save_db(db)
-        print(f"Video added: {title}")
-    except Exception as e:
-        print(f"Error processing video: {e}")
+            invalid.append(url)
+        elif store.has_video(video_id):
+            existing.append(video_id)
+        elif video_id not in new_urls:
+            new_urls[video_id] = url
+
+    make_video_folder(folder_name, username)
+
+    # Fetch thumbnails concurrently, without flooding the io pool's queue
+    semaphore = asyncio.Semaphore(config.BULK_THUMBNAIL_CONCURRENCY)
+    async def fetch(video_id):
+        async with semaphore:
+            return await download_thumbnail(video_id)
+    thumbnail_paths = await asyncio.gather(*(fetch(video_id) for video_id in new_urls))
+
+    await io_pool.run(store.put_videos, {
+        video_id: youtube_video_record(video_id, url, folder_name, username, thumbnail_path)
+        for (video_id, url), thumbnail_path in zip(new_urls.items(), thumbnail_paths)
+    })
+    print(f"Bulk import added {len(new_urls)} videos to {folder_name}")
+    return {"added": list(new_urls), "existing": existing, "invalid": invalid}
+
+async def run_ingest_job(job: dict, final_attempt: bool):
+    """Ingestion queue handler; the last attempt gives up on the thumbnail instead of retrying"""
+    params = job['params']
+    if job['kind'] == 'bulk':
+        return await import_videos(params['urls'], params['folder'], job['user_id'],
+                                   playlist_url=params.get('playlist_url'))
+    return await process_video(job['url'], params['folder'], job['user_id'],
+                               allow_missing_thumbnail=final_attempt)
+
+@app.post("/api/bulk_import")
+async def bulk_import(
+    urls: str = Form(""),
+    playlist_url: str = Form(None),
+    folder_path: str = Form(...),
+    user: dict = Depends(get_current_user)
+):
+    """Queue a list of video URLs (one per line) and/or a playlist for import into a folder"""
+    url_list = [url.strip() for url in urls.split() if url.strip()]
+    if not url_list and not playlist_url:
+        raise HTTPException(status_code=400, detail="Provide urls or a playlist_url")
+    if not folder_path.strip():
+        raise HTTPException(status_code=400, detail="Folder path is required")
+
+    # Identical submissions (same playlist and the same URLs in any order) share one job
+    job_key = "bulk:" + hashlib.sha1("\n".join([playlist_url or ""] + sorted(url_list)).encode()).hexdigest()
+    job = await ingest_queue.submit("bulk", user['username'], job_key, folder=folder_path.strip(),
+                              urls=url_list, playlist_url=playlist_url)
+    return {"message": "Bulk import started", "job_id": job['job_id'], "status": job['status']}
+
+@app.get("/api/jobs")
+async def list_jobs(user: dict = Depends(get_current_user)):
+    """Ingestion jobs of the current user, newest first"""
+    return {"jobs": await ingest_queue.jobs_for_user(user['username'])}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Status of one ingestion job"""
+    job = await ingest_queue.get(job_id)
+    if not job or job['user_id'] != user['username']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/admin/transcode/{video_id}")
+async def transcode_video(video_id: str, admin: dict = Depends(get_admin_user)):
+    """Queue HLS transcoding of a Telegram video"""
+    video = store.get_video(video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if video.get('source_type') != 'telegram':
+        raise HTTPException(status_code=400, detail="Only Telegram videos have media to transcode")
+    return await submit_transcode(video_id, admin['username'])
+
+@app.get("/api/admin/transcode")
+async def list_transcode_jobs(admin: dict = Depends(get_admin_user)):
+    """All transcoding jobs, newest first"""
+    return {"jobs": await transcode_queue.all_jobs()}
 
 @app.post("/api/delete_folder")
-async def delete_folder(folder_name: str = Form(...), auth_token: str = Cookie(None)):
+async def delete_folder(folder_name: str = Form(...), user: dict = Depends(get_current_user)):
     """Delete a folder and all its videos from the database and filesystem"""
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            raise HTTPException(status_code=401, detail="User not found")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
-    db = load_db()
-    folder_db = load_folder_db()
+    username = user['username']
 
     # Remove all user's videos in the folder
-    videos_to_delete = [video_id for video_id, video in db.items()
-                       if video.get('user_id') == username and video.get('folder_name') == folder_name]
-
-    for video_id in videos_to_delete:
-        del db[video_id]
+    videos_to_delete = [video['video_id'] for video in store.videos_for_user(username)
+                       if video.get('folder_name') == folder_name]
+    await io_pool.run(store.delete_videos, videos_to_delete)
 
     # Remove folder from folder_db if it belongs to user
-    if folder_name in folder_db and folder_db[folder_name].get('user_id') == username:
-        del folder_db[folder_name]
-        save_folder_db(folder_db)
-
-    save_db(db)
+    folder_info = store.get_folder(folder_name)
+    if folder_info and folder_info.get('user_id') == username:
+        await io_pool.run(store.delete_folders, [folder_name])
 
     # Delete physical folder if it exists and is empty
     folder_path = os.path.join("videos", username, folder_name)
@@ -707,61 +817,30 @@ async def delete_folder(folder_name: str = Form(...), auth_token: str = Cookie(N
 
 # Admin routes
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_panel(request: Request, auth_token: str = Cookie(None)):
+async def admin_panel(request: Request, user: dict = Depends(get_optional_user)):
     # Check if user is authenticated and is admin
-    if not auth_token:
+    if not user:
         return RedirectResponse("/login", status_code=302)
 
-    try:
-        from auth import verify_token
-        username = verify_token(auth_token)
-        if not username:
-            return RedirectResponse("/login", status_code=302)
-
-        from auth import load_users
-        users = load_users()
-        if username not in users:
-            return RedirectResponse("/login", status_code=302)
-
-        user = users[username]
-        if user.get("role") != "admin":
-            return RedirectResponse("/", status_code=302)  # Not admin, redirect to home
-
-    except Exception:
-        return RedirectResponse("/login", status_code=302)
+    if user.get("role") != "admin":
+        return RedirectResponse("/", status_code=302)  # Not admin, redirect to home
 
     return templates.TemplateResponse("admin.html", {"request": request, "current_user": user})
 
 @app.get("/api/admin/stats")
-async def get_admin_stats(auth_token: str = Cookie(None)):
-    # Verify admin access
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        user = users.get(username)
-
-        if not user or user.get("role") != "admin":
-            raise HTTPException(status_code=403, detail="Admin access required")
-
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
+async def get_admin_stats(admin: dict = Depends(get_admin_user)):
     # Calculate statistics
     all_users = load_users()
-    db = load_db()
+    videos = store.all_videos()
 
     total_users = len(all_users)
     active_users = sum(1 for u in all_users.values() if u.get("is_active", True))
-    total_videos = len(db)
-    total_views = sum(video.get("views_count", 0) for video in db.values())
+    total_videos = len(videos)
+    total_views = view_counter.total_views()
 
     # Calculate storage used (rough estimate)
     storage_used = 0
-    for video in db.values():
+    for video in videos:
         thumbnail_path = video.get("thumbnail_path", "")
         if thumbnail_path and os.path.exists(thumbnail_path):
             try:
@@ -773,8 +852,7 @@ async def get_admin_stats(auth_token: str = Cookie(None)):
     storage_used_mb = round(storage_used / (1024 * 1024), 2)
 
     # Count folders
-    folder_db = load_folder_db()
-    total_folders = len(folder_db)
+    total_folders = store.folder_count()
 
     return {
         "total_users": total_users,
@@ -782,27 +860,15 @@ async def get_admin_stats(auth_token: str = Cookie(None)):
         "total_videos": total_videos,
         "total_views": total_views,
         "storage_used": storage_used_mb,
-        "total_folders": total_folders
+        "total_folders": total_folders,
+        "fragment_cache": templates.env.fragment_cache.stats(),
+        "worker_pools": {pool.name: pool.stats() for pool in (extract_pool, io_pool, image_pool)},
+        # Only the leader worker runs the channel sync scheduler
+        "channel_sync": sync_scheduler.stats() if TELEGRAM_AVAILABLE and leader.is_leader else None
     }
 
 @app.get("/api/admin/users")
-async def get_all_users(auth_token: str = Cookie(None)):
-    # Verify admin access
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        user = users.get(username)
-
-        if not user or user.get("role") != "admin":
-            raise HTTPException(status_code=403, detail="Admin access required")
-
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
-
+async def get_all_users(admin: dict = Depends(get_admin_user)):
     # Return all users (exclude passwords)
     all_users = load_users()
     user_list = []
@@ -820,105 +886,53 @@ async def get_all_users(auth_token: str = Cookie(None)):
     return {"users": user_list}
 
 @app.post("/api/admin/users/{target_username}/toggle")
-async def toggle_user_status(target_username: str, auth_token: str = Cookie(None)):
-    # Verify admin access
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users, save_users
-        username = verify_token(auth_token)
-        users = load_users()
-        user = users.get(username)
-
-        if not user or user.get("role") != "admin":
-            raise HTTPException(status_code=403, detail="Admin access required")
+async def toggle_user_status(target_username: str, admin: dict = Depends(get_admin_user)):
+    users = load_users()
+    if target_username not in users:
+        raise HTTPException(status_code=404, detail="User not found")
 
-        if target_username not in users:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        if target_username == "admin":
-            raise HTTPException(status_code=400, detail="Cannot modify admin user")
-
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
+    if target_username == "admin":
+        raise HTTPException(status_code=400, detail="Cannot modify admin user")
 
     # Toggle user status
     users[target_username]["is_active"] = not users[target_username].get("is_active", True)
-    save_users(users)
+    await io_pool.run(save_users, users)
 
     return {"message": f"User {target_username} status updated"}
 
 @app.delete("/api/admin/users/{target_username}/delete")
-async def delete_user(target_username: str, auth_token: str = Cookie(None)):
-    # Verify admin access
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users, save_users
-        username = verify_token(auth_token)
-        users = load_users()
-        user = users.get(username)
-
-        if not user or user.get("role") != "admin":
-            raise HTTPException(status_code=403, detail="Admin access required")
-
-        if target_username not in users:
-            raise HTTPException(status_code=404, detail="User not found")
+async def delete_user(target_username: str, admin: dict = Depends(get_admin_user)):
+    users = load_users()
+    if target_username not in users:
+        raise HTTPException(status_code=404, detail="User not found")
 
-        if target_username == "admin":
-            raise HTTPException(status_code=400, detail="Cannot delete admin user")
-
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
+    if target_username == "admin":
+        raise HTTPException(status_code=400, detail="Cannot delete admin user")
 
     # Delete user and all their data
-    db = load_db()
-    folder_db = load_folder_db()
-
     # Remove user's videos
-    videos_to_delete = [vid for vid, video in db.items() if video.get("user_id") == target_username]
-    for vid in videos_to_delete:
-        del db[vid]
+    await io_pool.run(store.delete_videos, [video['video_id'] for video in store.videos_for_user(target_username)])
 
     # Remove user's folders
-    folders_to_delete = [fid for fid, folder in folder_db.items() if folder.get("user_id") == target_username]
-    for fid in folders_to_delete:
-        del folder_db[fid]
+    await io_pool.run(store.delete_folders, list(store.folders_for_user(target_username)))
 
     # Remove user account
     del users[target_username]
-
-    # Save changes
-    save_db(db)
-    save_folder_db(folder_db)
-    save_users(users)
+    await io_pool.run(save_users, users)
 
     return {"message": f"User {target_username} and all their data deleted"}
 
 @app.post("/api/create_subfolder")
-async def create_subfolder(parent_path: str = Form(...), subfolder_name: str = Form(...), auth_token: str = Cookie(None)):
+async def create_subfolder(parent_path: str = Form(...), subfolder_name: str = Form(...), user: dict = Depends(get_current_user)):
     """Create a new subfolder"""
-    if not auth_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-
-    try:
-        from auth import verify_token, load_users
-        username = verify_token(auth_token)
-        users = load_users()
-        if username not in users:
-            raise HTTPException(status_code=401, detail="User not found")
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid authentication")
+    username = user['username']
 
     if not subfolder_name or not subfolder_name.strip():
         raise HTTPException(status_code=400, detail="Subfolder name is required")
 
-    folder_db = load_folder_db()
     new_folder_path = f"{parent_path}/{subfolder_name.strip()}" if parent_path else subfolder_name.strip()
 
-    if new_folder_path in folder_db:
+    if store.has_folder(new_folder_path):
         raise HTTPException(status_code=400, detail="Folder already exists")
 
     # Create physical folder
@@ -926,52 +940,47 @@ async def create_subfolder(parent_path: str = Form(...), subfolder_name: str = F
     os.makedirs(folder_physical_path, exist_ok=True)
 
     # Save to folder database
-    folder_db[new_folder_path] = {
+    await io_pool.run(store.put_folder, new_folder_path, {
         'name': subfolder_name.strip(),
         'path': new_folder_path,
         'parent_path': parent_path,
         'user_id': username,
         'created_time': datetime.now().isoformat()
-    }
-    save_folder_db(folder_db)
+    })
 
     return {"message": f"Subfolder '{subfolder_name}' created successfully", "folder_path": new_folder_path}
 
 @app.post("/api/move_video")
 async def move_video(video_id: str = Form(...), new_folder_path: str = Form(...)):
     """Move a video to a different folder"""
-    db = load_db()
-    folder_db = load_folder_db()
-
-    if video_id not in db:
+    video = store.get_video(video_id)
+    if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    if new_folder_path and new_folder_path not in folder_db:
+    if new_folder_path and not store.has_folder(new_folder_path):
         raise HTTPException(status_code=400, detail="Target folder does not exist")
 
-    video = db[video_id]
-    old_folder = video.get('folder_path', video.get('folder_name', ''))
+    old_folder = video_folder(video)
 
     # Update video folder
-    video['folder_path'] = new_folder_path
-    video['folder_name'] = new_folder_path.split('/')[-1] if new_folder_path else ''
-
-    save_db(db)
+    await io_pool.run(
+        store.update_video,
+        video_id,
+        folder_path=new_folder_path,
+        folder_name=new_folder_path.split('/')[-1] if new_folder_path else ''
+    )
     return {"message": f"Video moved from '{old_folder}' to '{new_folder_path}'"}
 
 @app.post("/api/copy_video")
 async def copy_video(video_id: str = Form(...), new_folder_path: str = Form(...)):
     """Copy a video to a different folder"""
-    db = load_db()
-    folder_db = load_folder_db()
-
-    if video_id not in db:
+    video = store.get_video(video_id)
+    if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
-    if new_folder_path and new_folder_path not in folder_db:
+    if new_folder_path and not store.has_folder(new_folder_path):
         raise HTTPException(status_code=400, detail="Target folder does not exist")
 
-    video = db[video_id]
     new_video_id = f"{video_id}_copy_{int(datetime.now().timestamp())}"
 
     # Create copy of video
@@ -982,10 +991,14 @@ async def copy_video(video_id: str = Form(...), new_folder_path: str = Form(...)
     new_video['added_time'] = datetime.now().isoformat()
     new_video['views_count'] = 0
 
-    db[new_video_id] = new_video
-    save_db(db)
+    await io_pool.run(store.put_video, new_video_id, new_video)
 
     return {"message": f"Video copied to '{new_folder_path}'", "new_video_id": new_video_id}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
\ No newline at end of file
+    port = int(os.environ.get("PORT", 10000))
+    if config.WORKERS > 1:
+        # Each worker imports the app itself; they share state through the storage backend
+        uvicorn.run("app:app", host="0.0.0.0", port=port, workers=config.WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
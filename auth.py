@@ -1,19 +1,23 @@
-import json
+import copy
+import threading
+import time
 import bcrypt
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
 from typing import Optional
-from fastapi import HTTPException, Depends, Cookie
+from fastapi import HTTPException, Depends, Cookie, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from storage import backend
 
-# Simple JSON-based user storage (for simplicity)
-USERS_DB = "users_db.json"
+# Users are read from the storage backend once and kept here; save_users() replaces
+# them and refresh_users() reloads them when another worker process saved users
+_users_cache = None
+_users_generation = None
+_cache_lock = threading.Lock()
 
-def load_users():
-    try:
-        with open(USERS_DB, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
+def _read_users():
+    users = backend.load_users()
+    if users is None:
         # Create default admin user
         default_user = {
             "admin": {
@@ -29,16 +33,64 @@ def load_users():
         }
         save_users(default_user)
         return default_user
+    return users
+
+def _replace_cache(users, generation):
+    """Install a new users dict (under _cache_lock), forgetting tokens of users that changed"""
+    global _users_cache, _users_generation
+    old_users = _users_cache or {}
+    _users_cache = copy.deepcopy(users)
+    _users_generation = generation
+    changed = {name for name, user in old_users.items() if users.get(name) != user}
+    if changed:
+        for token, entry in list(_token_cache.items()):
+            if entry[0] in changed:
+                del _token_cache[token]
+
+def refresh_users():
+    """Reload the users if they were never read or another worker process saved them"""
+    generation = backend.generation("users")
+    if _users_cache is not None and generation == _users_generation:
+        return
+    users = _read_users()
+    with _cache_lock:
+        if _users_cache is None or _users_generation != generation:
+            _replace_cache(users, generation)
+
+def _cached_users():
+    """Shared users dict for read-only lookups (never mutate the result)"""
+    if _users_cache is None:
+        refresh_users()
+    return _users_cache
+
+def load_users():
+    """Up to date copy of all users; mutate it freely and pass it to save_users()"""
+    refresh_users()
+    return copy.deepcopy(_cached_users())
 
 def save_users(users):
-    with open(USERS_DB, 'w') as f:
-        json.dump(users, f, indent=2)
+    with _cache_lock:
+        old_users = _users_cache or {}
+        # Only users that were added, changed or removed are written
+        changed = {name for name in old_users.keys() | users.keys() if users.get(name) != old_users.get(name)}
+        generation = backend.save_users(users, changed)
+        if generation != (_users_generation or 0) + 1:
+            # Another worker saved users since we last read them
+            users = backend.load_users() or users
+        _replace_cache(users, generation)
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 6 * 30 * 24 * 60  # 6 months
 
+# Verified tokens are remembered so repeat requests skip the JWT decode
+AUTH_CACHE_TTL = 300  # seconds
+AUTH_CACHE_SIZE = 10000
+
+# token -> (username, user record, expires at)
+_token_cache = {}
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -56,6 +108,30 @@ def verify_token(token: str) -> Optional[str]:
     except JWTError:
         return None
 
+def get_user_for_token(token: str) -> Optional[dict]:
+    """Resolve a token to its user record, using the verified-token cache"""
+    now = time.time()
+    entry = _token_cache.get(token)
+    if entry is not None and entry[2] > now:
+        return entry[1]
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    user = _cached_users().get(username) if username else None
+    if user is None or not user.get("is_active", True):
+        return None
+
+    with _cache_lock:
+        if len(_token_cache) >= AUTH_CACHE_SIZE:
+            # Drop the oldest entry (dicts keep insertion order)
+            del _token_cache[next(iter(_token_cache))]
+        expires_at = min(now + AUTH_CACHE_TTL, payload.get("exp", now))
+        _token_cache[token] = (username, user, expires_at)
+    return user
+
 def authenticate_user(username: str, password: str):
     users = load_users()
     if username not in users:
@@ -96,16 +172,24 @@ def register_user(username: str, email: str, password: str):
     save_users(users)
     return users[username]
 
-def get_current_user(token: Optional[str] = Cookie(None)):
-    if not token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+def get_optional_user(request: Request, auth_token: Optional[str] = Cookie(None)) -> Optional[dict]:
+    """Current user from the auth_token cookie, or None.
 
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    The result is kept on request.state so a request resolves its user
+    once, however many dependencies or handlers ask for it.
+    """
+    if hasattr(request.state, "current_user"):
+        return request.state.current_user
+    user = get_user_for_token(auth_token) if auth_token else None
+    request.state.current_user = user
+    return user
 
-    users = load_users()
-    if username not in users:
-        raise HTTPException(status_code=401, detail="User not found")
+def get_current_user(user: Optional[dict] = Depends(get_optional_user)) -> dict:
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
 
-    return users[username]
\ No newline at end of file
+def get_admin_user(user: dict = Depends(get_current_user)) -> dict:
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
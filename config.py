@@ -18,12 +18,142 @@ PORT = int(os.environ.get("PORT", 10000))
 
 # Sync interval in seconds (how often to check for new videos)
 SYNC_INTERVAL = int(os.environ.get("SYNC_INTERVAL", 3600))  # Default 1 hour
+# Per-channel intervals as "channel=seconds,..." (other channels use SYNC_INTERVAL).
+# Each run is rescheduled SYNC_JITTER (a fraction of the interval) early or
+# late at random, so channels drift apart instead of syncing all at once.
+CHANNEL_SYNC_INTERVALS = {
+    channel.strip(): int(seconds)
+    for channel, _, seconds in (item.partition("=") for item in os.environ.get("CHANNEL_SYNC_INTERVALS", "").split(","))
+    if channel.strip() and seconds
+}
+SYNC_JITTER = float(os.environ.get("SYNC_JITTER", 0.1))
+SYNC_JOBS_FILE = os.environ.get("SYNC_JOBS_FILE", "sync_jobs.json")  # Manual syncs waiting for the leader
+# A full resync waits for a running sync of its channel; with INGEST_RETRY_BACKOFF
+# doubling per attempt, 8 attempts cover about 20 minutes
+SYNC_JOB_MAX_ATTEMPTS = int(os.environ.get("SYNC_JOB_MAX_ATTEMPTS", 8))
 
-# JSON cache file
-VIDEO_CACHE_FILE = "video_cache.json"
+# Highest message id synced from each channel; syncs only fetch newer messages
+SYNC_CHECKPOINT_FILE = os.environ.get("SYNC_CHECKPOINT_FILE", "sync_checkpoints.json")
 
 # Thumbnails directory
 THUMBNAILS_DIR = "static/thumbnails"
 
 # Session file for Telegram client
-SESSION_FILE = "telegram_session"
\ No newline at end of file
+SESSION_FILE = "telegram_session"
+
+# Storage backend: "json" (whole-file JSON plus a write-ahead log, for small
+# installs) or "sqlite" (safe with several worker processes). The SQLite
+# database is filled from the JSON files the first time it is opened.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_DB_FILE = os.environ.get("SQLITE_DB_FILE", "videohub.db")
+
+# Worker processes ("auto" = one per CPU). With more than one, the workers
+# coordinate through file locks and pick up each other's changes every
+# STORE_SYNC_INTERVAL seconds; singleton background tasks (compaction,
+# ingestion) run in whichever worker holds the leader lock.
+WORKERS = os.environ.get("WORKERS", "1")
+WORKERS = (os.cpu_count() or 1) if WORKERS == "auto" else int(WORKERS)
+STORE_SYNC_INTERVAL = float(os.environ.get("STORE_SYNC_INTERVAL", 1))
+STORE_GENERATION_FILE = os.environ.get("STORE_GENERATION_FILE", "store_generation.json")  # JSON backend
+STORE_CHANGE_RETENTION = int(os.environ.get("STORE_CHANGE_RETENTION", 10000))  # SQLite change rows kept
+LEADER_LOCK_FILE = os.environ.get("LEADER_LOCK_FILE", "videohub.leader.lock")
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", 10))
+
+# Video store write-ahead log and compaction (JSON backend)
+STORE_LOG_FILE = os.environ.get("STORE_LOG_FILE", "video_db.log")
+STORE_FSYNC = os.environ.get("STORE_FSYNC", "1") != "0"
+STORE_COMPACT_INTERVAL = int(os.environ.get("STORE_COMPACT_INTERVAL", 300))  # Seconds between compactions
+STORE_COMPACT_THRESHOLD = int(os.environ.get("STORE_COMPACT_THRESHOLD", 1000))  # Log records that force one
+
+# Buffered view counts are written to the store every interval or threshold views
+VIEW_FLUSH_INTERVAL = int(os.environ.get("VIEW_FLUSH_INTERVAL", 10))
+VIEW_FLUSH_THRESHOLD = int(os.environ.get("VIEW_FLUSH_THRESHOLD", 100))
+
+# Extracted stream URLs are cached until shortly before their signed expiry
+STREAM_CACHE_TTL = int(os.environ.get("STREAM_CACHE_TTL", 3600))  # Used when the URL carries no expiry
+STREAM_CACHE_MARGIN = int(os.environ.get("STREAM_CACHE_MARGIN", 300))  # Refresh this long before expiry
+STREAM_CACHE_SIZE = int(os.environ.get("STREAM_CACHE_SIZE", 5000))
+
+# Worker pools for blocking work (yt-dlp extraction, downloads, file I/O).
+# Requests are rejected with HTTP 503 once a pool has QUEUE_LIMIT jobs waiting.
+EXTRACT_POOL_SIZE = int(os.environ.get("EXTRACT_POOL_SIZE", 4))
+EXTRACT_QUEUE_LIMIT = int(os.environ.get("EXTRACT_QUEUE_LIMIT", 32))
+IO_POOL_SIZE = int(os.environ.get("IO_POOL_SIZE", 8))
+IO_QUEUE_LIMIT = int(os.environ.get("IO_QUEUE_LIMIT", 256))
+IMAGE_POOL_SIZE = int(os.environ.get("IMAGE_POOL_SIZE", max(1, (os.cpu_count() or 1) // 2)))  # Processes
+IMAGE_QUEUE_LIMIT = int(os.environ.get("IMAGE_QUEUE_LIMIT", 64))
+
+# Ingestion job queue for /add_video
+INGEST_JOBS_FILE = os.environ.get("INGEST_JOBS_FILE", "ingest_jobs.json")
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+INGEST_MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", 1000))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", 4))
+INGEST_RETRY_BACKOFF = float(os.environ.get("INGEST_RETRY_BACKOFF", 5))  # Seconds, doubled per attempt
+INGEST_JOB_RETENTION = int(os.environ.get("INGEST_JOB_RETENTION", 24 * 3600))  # Keep finished jobs this long
+INGEST_POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", 1))  # How often the leader picks up new jobs
+
+# Concurrent thumbnail downloads per bulk import
+BULK_THUMBNAIL_CONCURRENCY = int(os.environ.get("BULK_THUMBNAIL_CONCURRENCY", 8))
+
+# Thumbnail fetching. Point THUMBNAIL_BASE_URL at a local server to test without YouTube.
+THUMBNAIL_BASE_URL = os.environ.get("THUMBNAIL_BASE_URL", "https://img.youtube.com")
+THUMBNAIL_VARIANTS = ["maxresdefault", "hqdefault", "mqdefault"]  # Tried in this order
+THUMBNAIL_CONCURRENCY = int(os.environ.get("THUMBNAIL_CONCURRENCY", 10))  # Pooled connections
+THUMBNAIL_TIMEOUT = float(os.environ.get("THUMBNAIL_TIMEOUT", 15))
+THUMBNAIL_INDEX_FILE = os.environ.get("THUMBNAIL_INDEX_FILE", "thumbnail_index.jsonl")
+# Resized thumbnails (WebP and JPEG), made on first request in the image pool:
+# widths offered to browsers through srcset (the smallest for video grids, the
+# largest for the watch page), where they are kept, and encoder quality
+THUMBNAIL_WIDTHS = [int(width) for width in os.environ.get("THUMBNAIL_WIDTHS", "320,640").split(",")]
+THUMBNAIL_DERIVED_DIR = os.environ.get("THUMBNAIL_DERIVED_DIR", "static/thumbnails/derived")
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+
+# Shared Telegram client: channels fetched at once, flood waits pyrogram sleeps
+# through by itself (longer ones pause all callers), attempts per call
+TELEGRAM_FETCH_CONCURRENCY = int(os.environ.get("TELEGRAM_FETCH_CONCURRENCY", 3))
+TELEGRAM_SLEEP_THRESHOLD = int(os.environ.get("TELEGRAM_SLEEP_THRESHOLD", 10))
+TELEGRAM_MAX_ATTEMPTS = int(os.environ.get("TELEGRAM_MAX_ATTEMPTS", 3))
+TELEGRAM_INGEST_BATCH_SIZE = int(os.environ.get("TELEGRAM_INGEST_BATCH_SIZE", 50))  # Videos per store write
+
+# Telegram media streaming: concurrent downloads from Telegram, chunks fetched
+# per download, and an on-disk cache of 1 MiB chunks capped at CHUNK_CACHE_SIZE bytes
+TELEGRAM_STREAM_CONCURRENCY = int(os.environ.get("TELEGRAM_STREAM_CONCURRENCY", 4))
+TELEGRAM_STREAM_READAHEAD = int(os.environ.get("TELEGRAM_STREAM_READAHEAD", 8))
+TELEGRAM_CHUNK_CACHE_DIR = os.environ.get("TELEGRAM_CHUNK_CACHE_DIR", "telegram_cache")
+TELEGRAM_CHUNK_CACHE_SIZE = int(os.environ.get("TELEGRAM_CHUNK_CACHE_SIZE", 2 * 1024 ** 3))
+
+# HLS transcoding of Telegram videos (downloaded to TRANSCODE_WORK_DIR first).
+# Renditions are "height:video kbps" pairs; renditions taller than the source
+# are skipped. Each job is one ffmpeg process, TRANSCODE_WORKERS at a time,
+# splitting the CPUs between them. With TRANSCODE_TELEGRAM=1 every newly
+# synced Telegram video is queued.
+TRANSCODE_RENDITIONS = [
+    tuple(int(value) for value in rendition.split(":"))
+    for rendition in os.environ.get("TRANSCODE_RENDITIONS", "1080:5000,720:2800,480:1400,360:800").split(",")
+]
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", max(1, (os.cpu_count() or 1) // 4)))
+TRANSCODE_THREADS = int(os.environ.get("TRANSCODE_THREADS", max(1, (os.cpu_count() or 1) // TRANSCODE_WORKERS)))
+TRANSCODE_SEGMENT_SECONDS = int(os.environ.get("TRANSCODE_SEGMENT_SECONDS", 6))
+TRANSCODE_AUDIO_BITRATE = int(os.environ.get("TRANSCODE_AUDIO_BITRATE", 128))  # kbps
+TRANSCODE_TELEGRAM = os.environ.get("TRANSCODE_TELEGRAM", "0") != "0"
+TRANSCODE_JOBS_FILE = os.environ.get("TRANSCODE_JOBS_FILE", "transcode_jobs.json")
+TRANSCODE_WORK_DIR = os.environ.get("TRANSCODE_WORK_DIR", "transcode_work")
+HLS_DIR = os.path.join("videos", "hls")  # Served from the /videos mount
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.environ.get("FFPROBE_BIN", "ffprobe")
+
+# Static and media files. Content-addressed files (thumbnails, assets linked
+# with their hash) are cached as immutable; others for MEDIA_MAX_AGE seconds,
+# then revalidated by ETag. ETags hash the content of files up to
+# MEDIA_HASH_MAX_BYTES; bigger ones are tagged by inode, size and mtime.
+MEDIA_MAX_AGE = int(os.environ.get("MEDIA_MAX_AGE", 300))
+MEDIA_HASH_MAX_BYTES = int(os.environ.get("MEDIA_HASH_MAX_BYTES", 16 * 1024 * 1024))
+MEDIA_CHUNK_SIZE = int(os.environ.get("MEDIA_CHUNK_SIZE", 1024 * 1024))  # Reads when the server has no zero-copy send
+
+# Rendered page sections (video grids, folder lists), cached per user until
+# that user's videos or folders change; at most FRAGMENT_CACHE_SIZE characters
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 16 * 1024 * 1024))
+
+# Video listings (home, folder pages, /api/videos)
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 24))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 100))
@@ -0,0 +1,162 @@
+import bisect
+import heapq
+from typing import Dict, Iterator, List, Optional
+
+
+class FolderNode:
+    __slots__ = ('name', 'children', 'video_ids', 'keys', 'explicit', 'total')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.children: Dict[str, 'FolderNode'] = {}
+        self.video_ids = set()
+        self.keys: List[tuple] = []  # Sort keys of the videos here, oldest first
+        self.explicit = False  # Created through folder_db rather than implied by a video
+        self.total = 0  # Videos in this folder and all of its subfolders
+
+
+class FolderTree:
+    """One user's folder hierarchy with direct and recursive video counts.
+
+    Kept up to date by VideoStore as videos and folders are added, moved or
+    removed, so rendering the hierarchy costs O(size of the tree) instead
+    of a scan over the whole catalog. Each folder also keeps its videos'
+    listing keys sorted, so folder pages are read without sorting. Nodes that exist only because a video
+    pointed at them disappear again once they are empty.
+    """
+
+    def __init__(self):
+        self.root = FolderNode('')
+
+    def __bool__(self):
+        return bool(self.root.children)
+
+    @staticmethod
+    def _parts(path: str) -> List[str]:
+        return path.split('/')
+
+    def find(self, path: str) -> Optional[FolderNode]:
+        node = self.root
+        for part in self._parts(path):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _walk(self, path: str) -> List[FolderNode]:
+        """Nodes from the root down to path, creating missing ones"""
+        nodes = [self.root]
+        for part in self._parts(path):
+            node = nodes[-1].children.get(part)
+            if node is None:
+                node = nodes[-1].children[part] = FolderNode(part)
+            nodes.append(node)
+        return nodes
+
+    def _prune(self, nodes: List[FolderNode]):
+        for parent, node in zip(reversed(nodes[:-1]), reversed(nodes[1:])):
+            if node.video_ids or node.explicit or node.children:
+                break
+            del parent.children[node.name]
+
+    def add_video(self, path: str, video_id: str, key: tuple):
+        nodes = self._walk(path)
+        if video_id in nodes[-1].video_ids:
+            return
+        nodes[-1].video_ids.add(video_id)
+        bisect.insort(nodes[-1].keys, key)
+        for node in nodes:
+            node.total += 1
+
+    def remove_video(self, path: str, video_id: str, key: tuple):
+        node = self.find(path)
+        if node is None or video_id not in node.video_ids:
+            return
+        nodes = self._walk(path)
+        nodes[-1].video_ids.discard(video_id)
+        index = bisect.bisect_left(node.keys, key)
+        if index < len(node.keys) and node.keys[index] == key:
+            del node.keys[index]
+        for node in nodes:
+            node.total -= 1
+        self._prune(nodes)
+
+    def add_folder(self, path: str):
+        self._walk(path)[-1].explicit = True
+
+    def remove_folder(self, path: str):
+        node = self.find(path)
+        if node is None:
+            return
+        node.explicit = False
+        self._prune(self._walk(path))
+
+    def video_ids(self, path: str, recursive: bool = True) -> List[str]:
+        """IDs of the videos in a folder, optionally including every subfolder"""
+        node = self.find(path)
+        if node is None:
+            return []
+        if not recursive:
+            return list(node.video_ids)
+        ids = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            ids.extend(node.video_ids)
+            stack.extend(node.children.values())
+        return ids
+
+    def newest_keys(self, path: str, recursive: bool = True, before: Optional[tuple] = None) -> Iterator[tuple]:
+        """Listing keys of a folder's videos newest first, starting below before"""
+        node = self.find(path)
+        if node is None:
+            return iter(())
+        nodes = [node]
+        if recursive:
+            stack = [node]
+            while stack:
+                children = stack.pop().children.values()
+                nodes.extend(children)
+                stack.extend(children)
+        return heapq.merge(*(self._newest(node.keys, before) for node in nodes if node.keys), reverse=True)
+
+    @staticmethod
+    def _newest(keys: List[tuple], before: Optional[tuple]) -> Iterator[tuple]:
+        end = bisect.bisect_left(keys, before) if before is not None else len(keys)
+        return (keys[index] for index in range(end - 1, -1, -1))
+
+    def children(self, path: str) -> Dict[str, str]:
+        """Immediate subfolders of a folder as {name: full path}"""
+        node = self.find(path)
+        if node is None:
+            return {}
+        return {name: f"{path}/{name}" for name in node.children}
+
+    def to_hierarchy(self) -> dict:
+        """Nested {name: {'count', 'total', 'subfolders'}} dict used by the templates"""
+        def build(node):
+            return {
+                name: {'count': len(child.video_ids), 'total': child.total, 'subfolders': build(child)}
+                for name, child in node.children.items()
+            }
+        return build(self.root)
+
+    def flatten(self) -> List[dict]:
+        """Depth-first list of every folder, as returned by /api/folders"""
+        folders = []
+
+        def visit(node, prefix):
+            for name, child in node.children.items():
+                full_path = f"{prefix}/{name}" if prefix else name
+                folders.append({
+                    'name': full_path,
+                    'display_name': name,
+                    'count': len(child.video_ids),
+                    'total': child.total,
+                    'path': full_path,
+                    'has_subfolders': bool(child.children)
+                })
+                visit(child, full_path)
+
+        visit(self.root, '')
+        return folders
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+import config
+
+
+class FragmentCache:
+    """LRU cache of rendered template fragments, per user.
+
+    Entries are keyed by (user, fragment name and arguments) and remember
+    the user's data version (see VideoStore.data_version) they were
+    rendered at, plus any state the fragment varies on that the version
+    does not cover; once either changes the entry is rendered again. The
+    cache holds at most max_size characters of HTML.
+    """
+
+    def __init__(self, version: Callable[[str], int], max_size: int = config.FRAGMENT_CACHE_SIZE):
+        self.version = version
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: tuple, version) -> Optional[Markup]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: tuple, version, html: Markup):
+        self._discard(key)
+        if len(html) > self.max_size:
+            return
+        self._entries[key] = (version, html)
+        self.size += len(html)
+        while self.size > self.max_size:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def render(self, user_id: str, key: tuple, render: Callable[[], Markup], vary=None) -> Markup:
+        """Cached HTML of a user's fragment, rendering it on a miss"""
+        key = (user_id, *key)
+        version = (self.version(user_id), vary)
+        html = self.get(key, version)
+        if html is None:
+            html = render()
+            self.put(key, version, html)
+        return html
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache user, name, *args [vary expr] %}...{% endcache %} caches a section's HTML.
+
+    The first argument is the user whose data the section shows; the rest
+    name the section and everything else it depends on (folder path,
+    options). State that changes without bumping the user's data version,
+    like buffered view counts, goes after vary: the entry is re-rendered
+    in place when it changes. Set environment.fragment_cache to a
+    FragmentCache to enable it; without one sections are rendered every time.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        vary = parser.parse_expression() if parser.stream.skip_if('name:vary') else nodes.Const(None)
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args), vary]), [], [], body).set_lineno(lineno)
+
+    def _render(self, args: list, vary, caller) -> Markup:
+        cache = self.environment.fragment_cache
+        if cache is None or args[0] is None:
+            return caller()
+        return cache.render(args[0], tuple(args[1:]), caller, vary)
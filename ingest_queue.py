@@ -0,0 +1,229 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import config
+from locks import FileLock
+from storage import read_json, write_json
+from worker_pool import PoolSaturated, io_pool
+
+ACTIVE_STATUSES = ('queued', 'running', 'retrying')
+
+
+class RetryableJobError(Exception):
+    """A job failure worth retrying after a backoff (e.g. a failed download)"""
+
+
+class IngestQueue:
+    """Durable queue of video ingestion jobs processed by a fixed worker count.
+
+    Jobs are kept in ingest_jobs.json and rewritten on every status change,
+    so queued work survives a restart. Any worker process may submit jobs
+    and read their status; the file is only changed under a file lock and
+    re-read whenever another process changed it. Only the process that
+    called start() (the leader) runs jobs: it picks up queued jobs every
+    INGEST_POLL_INTERVAL seconds, and on start requeues jobs a previous
+    leader left running. Submitting a URL that the same user already has in
+    flight returns the existing job. Jobs failing with RetryableJobError (or
+    a saturated worker pool) are retried with exponential backoff; the
+    handler is told when it is on its last attempt. Reads and rewrites of
+    the jobs file made from the event loop go through the io pool; the
+    jobs dict is replaced rather than changed in place, so the loop can
+    read it while a pool thread writes.
+    """
+
+    def __init__(self, path: str = config.INGEST_JOBS_FILE, workers: int = config.INGEST_WORKERS,
+                 max_pending: int = config.INGEST_MAX_PENDING, max_attempts: int = config.INGEST_MAX_ATTEMPTS,
+                 retry_backoff: float = config.INGEST_RETRY_BACKOFF, retention: int = config.INGEST_JOB_RETENTION,
+                 poll_interval: float = config.INGEST_POLL_INTERVAL):
+        self.path = path
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.jobs: Dict[str, dict] = {}
+        self.handler: Optional[Callable[[dict, bool], Awaitable[dict]]] = None
+        self._file_lock = FileLock(f"{path}.lock")
+        self._loaded_signature = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._dispatched = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def load(self):
+        """Re-read the jobs file if another process changed it since we last did"""
+        signature = self._signature()
+        if signature is None or signature != self._loaded_signature:
+            self.jobs = read_json(self.path)
+            self._loaded_signature = signature
+
+    def _signature(self):
+        # write_json() replaces the file, so every save gets a new inode
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def save(self):
+        now = time.time()
+        self.jobs = {job_id: job for job_id, job in self.jobs.items()
+                     if job['status'] in ACTIVE_STATUSES or now - job['updated_at'] <= self.retention}
+        write_json(self.path, self.jobs)
+        self._loaded_signature = self._signature()
+
+    def start(self, handler: Callable[[dict, bool], Awaitable[dict]]):
+        """Start running jobs in this process; handler(job, final_attempt) processes one job"""
+        self.handler = handler
+        self._queue = asyncio.Queue()
+        with self._file_lock:
+            self.load()
+            for job in self.jobs.values():
+                if job['status'] == 'running':
+                    # Its leader went away part way through
+                    job['status'] = 'queued'
+            self.save()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._dispatcher()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def pending_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if job['status'] in ACTIVE_STATUSES)
+
+    async def submit(self, kind: str, user_id: str, url: str, **params) -> dict:
+        """Queue a job, or return the user's in-flight job for the same URL"""
+        job, created = await io_pool.run(self._submit, kind, user_id, url, params)
+        if created and self._queue is not None:
+            self._dispatch(job['job_id'])
+        return job
+
+    def _submit(self, kind: str, user_id: str, url: str, params: dict):
+        """(job, whether it was created) for submit(); blocking"""
+        with self._file_lock:
+            self.load()
+            for job in self.jobs.values():
+                if (job['status'] in ACTIVE_STATUSES and job['kind'] == kind
+                        and job['user_id'] == user_id and job['url'] == url):
+                    return job, False
+
+            if self.pending_count() >= self.max_pending:
+                raise PoolSaturated("ingest")
+
+            now = time.time()
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'kind': kind,
+                'user_id': user_id,
+                'url': url,
+                'params': params,
+                'status': 'queued',
+                'attempts': 0,
+                'error': None,
+                'result': None,
+                'created_at': now,
+                'updated_at': now,
+            }
+            self.jobs = {**self.jobs, job['job_id']: job}
+            self.save()
+        return job, True
+
+    async def refresh(self):
+        """load() on the io pool"""
+        await io_pool.run(self.load)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        await self.refresh()
+        return self.jobs.get(job_id)
+
+    async def all_jobs(self) -> List[dict]:
+        """Every job, newest first"""
+        await self.refresh()
+        return sorted(self.jobs.values(), key=lambda job: job['created_at'], reverse=True)
+
+    async def jobs_for_user(self, user_id: str) -> List[dict]:
+        return [job for job in await self.all_jobs() if job['user_id'] == user_id]
+
+    def _update(self, job_id: str, **fields) -> dict:
+        """Change a job's fields in the shared file and return the new record"""
+        with self._file_lock:
+            self.load()
+            job = dict(self.jobs[job_id], **fields, updated_at=time.time())
+            self.jobs = {**self.jobs, job_id: job}
+            self.save()
+            return dict(job)
+
+    async def _set(self, job_id: str, **fields) -> dict:
+        """_update() on the io pool, waiting for room when it is saturated"""
+        while True:
+            try:
+                return await io_pool.run(self._update, job_id, **fields)
+            except PoolSaturated:
+                await asyncio.sleep(self.poll_interval)
+
+    def _dispatch(self, job_id: str):
+        if job_id not in self._dispatched:
+            self._dispatched.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _queued_jobs(self) -> List[str]:
+        """IDs of the queued jobs, oldest first, after requeueing due retries; blocking"""
+        now = time.time()
+        with self._file_lock:
+            self.load()
+            due = {job_id: dict(job, status='queued', updated_at=now) for job_id, job in self.jobs.items()
+                   if job['status'] == 'retrying' and job.get('retry_at', 0) <= now}
+            if due:
+                self.jobs = {**self.jobs, **due}
+                self.save()
+            return [job['job_id'] for job in sorted(self.jobs.values(), key=lambda job: job['created_at'])
+                    if job['status'] == 'queued']
+
+    async def _dispatcher(self):
+        """Hand queued jobs (from any process) and due retries to the workers"""
+        while True:
+            try:
+                queued = await io_pool.run(self._queued_jobs)
+            except PoolSaturated:
+                queued = []  # Try again next round
+            for job_id in queued:
+                self._dispatch(job_id)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._dispatched.discard(job_id)
+            while True:
+                try:
+                    await self.refresh()
+                    break
+                except PoolSaturated:
+                    await asyncio.sleep(self.poll_interval)
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                continue
+
+            job = await self._set(job_id, status='running', attempts=job['attempts'] + 1)
+            final_attempt = job['attempts'] >= self.max_attempts
+            try:
+                result = await self.handler(job, final_attempt)
+            except (RetryableJobError, PoolSaturated) as e:
+                if final_attempt:
+                    await self._set(job_id, status='failed', error=str(e))
+                else:
+                    delay = self.retry_backoff * 2 ** (job['attempts'] - 1)
+                    await self._set(job_id, status='retrying', error=str(e), retry_at=time.time() + delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ingestion job {job_id} failed: {e}")
+                await self._set(job_id, status='failed', error=str(e))
+            else:
+                await self._set(job_id, status='done', error=None, result=result)
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import threading
+from typing import Callable
+
+try:
+    import fcntl
+except ImportError:  # Not POSIX: only one worker process is supported
+    fcntl = None
+
+import config
+
+
+class FileLock:
+    """Exclusive lock shared by threads and worker processes.
+
+    Threads of one process serialize on an RLock; processes serialize on an
+    flock() of the lock file, taken by the outermost holder. Reentrant, so
+    code holding it may call other code that takes it again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._file = open(self.path, 'a')
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+class LeaderLock:
+    """Held by at most one worker process; the holder runs the singleton tasks.
+
+    The lock is an flock() that the kernel drops when the holder exits, so
+    another worker can take over after a crash.
+    """
+
+    def __init__(self, path: str = config.LEADER_LOCK_FILE):
+        self.path = path
+        self.is_leader = False
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        if self.is_leader or fcntl is None:
+            self.is_leader = True
+            return True
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.truncate(0)
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+        self.is_leader = True
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self.is_leader = False
+
+
+async def run_leader_election(lock: LeaderLock, on_elected: Callable[[], None],
+                              interval: float = config.LEADER_RETRY_INTERVAL):
+    """Background task calling on_elected() once this process becomes the leader"""
+    while not lock.try_acquire():
+        await asyncio.sleep(interval)
+    print(f"Worker {os.getpid()} is the leader")
+    on_elected()
@@ -0,0 +1,174 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Optional, Pattern
+
+import anyio
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Receive, Scope, Send
+
+import config
+from telegram_stream import parse_range
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class DigestCache:
+    """Content hashes of files, remembered per (path, size, mtime).
+
+    Files larger than max_bytes are not read; their tag is derived from
+    the inode, size and modification time instead, which still changes
+    whenever the file is replaced or rewritten.
+    """
+
+    def __init__(self, max_bytes: int = config.MEDIA_HASH_MAX_BYTES, max_entries: int = 10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._digests: OrderedDict = OrderedDict()
+
+    def digest(self, path: str, stat_result: Optional[os.stat_result] = None) -> str:
+        stat_result = stat_result or os.stat(path)
+        key = (path, stat_result.st_size, stat_result.st_mtime_ns)
+        with self.lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+                return digest
+        if stat_result.st_size > self.max_bytes:
+            digest = f"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+        else:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()[:32]
+        with self.lock:
+            self._digests[key] = digest
+            while len(self._digests) > self.max_entries:
+                self._digests.popitem(last=False)
+        return digest
+
+
+digests = DigestCache()
+
+
+class MediaFileResponse(Response):
+    """A file with a strong ETag, conditional requests and single Range requests.
+
+    The ETag is the file's content hash (see DigestCache), worked out off
+    the event loop when the response is sent. If-None-Match answers 304,
+    and If-Range falls back to the whole file once the tag has changed.
+    The body goes out through the server's zero-copy extension when it
+    offers one (http.response.zerocopysend, or pathsend for whole files),
+    otherwise in MEDIA_CHUNK_SIZE reads.
+    """
+
+    chunk_size = config.MEDIA_CHUNK_SIZE
+
+    def __init__(self, path: str, stat_result: os.stat_result, max_age: int = config.MEDIA_MAX_AGE,
+                 immutable: bool = False, fingerprint: Optional[str] = None):
+        super().__init__(media_type=mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.path = path
+        self.stat_result = stat_result
+        self.max_age = max_age
+        self.immutable = immutable
+        self.fingerprint = fingerprint  # ?v= of the URL; immutable if it is the content hash
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        request_headers = Headers(scope=scope)
+        digest = await anyio.to_thread.run_sync(digests.digest, self.path, self.stat_result)
+        etag = f'"{digest}"'
+        immutable = self.immutable or (len(self.fingerprint or '') >= 12 and digest.startswith(self.fingerprint))
+        self.headers["etag"] = etag
+        self.headers["cache-control"] = IMMUTABLE if immutable else f"public, max-age={self.max_age}, must-revalidate"
+        self.headers["last-modified"] = formatdate(self.stat_result.st_mtime, usegmt=True)
+        self.headers["accept-ranges"] = "bytes"
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            del self.headers["content-length"]
+            return await self._send_empty(send, 304)
+
+        size = self.stat_result.st_size
+        start, end = 0, size - 1
+        if_range = request_headers.get("if-range")
+        if size and (if_range is None or if_range == etag):
+            try:
+                byte_range = parse_range(request_headers.get("range"), size)
+            except ValueError:
+                self.headers["content-range"] = f"bytes */{size}"
+                self.headers["content-length"] = "0"
+                return await self._send_empty(send, 416)
+            if byte_range is not None:
+                start, end = byte_range
+                self.status_code = 206
+                self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        length = end - start + 1 if size else 0
+        self.headers["content-length"] = str(length)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        extensions = scope.get("extensions") or {}
+        if scope["method"].upper() == "HEAD" or not length:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in extensions:
+            with open(self.path, 'rb') as f:
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(),
+                            "offset": start, "count": length, "more_body": False})
+        elif "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as f:
+                await f.seek(start)
+                remaining = length
+                while remaining:
+                    chunk = await f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break  # File shrank while being sent
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": bool(remaining)})
+                if remaining:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_empty(self, send: Send, status: int):
+        await send({"type": "http.response.start", "status": status, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class MediaFiles(StaticFiles):
+    """StaticFiles serving through MediaFileResponse.
+
+    Files whose path matches immutable_pattern (content-addressed names,
+    like the thumbnails) and URLs whose ?v= is the file's content hash
+    (see asset_url) are cached by browsers for a year without revalidating.
+    Everything else may be reused for max_age seconds, then is revalidated
+    by ETag.
+    """
+
+    def __init__(self, *args, immutable_pattern: Optional[str] = None,
+                 max_age: int = config.MEDIA_MAX_AGE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.immutable_pattern: Optional[Pattern] = re.compile(immutable_pattern) if immutable_pattern else None
+        self.max_age = max_age
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        path = self.get_path(scope)
+        immutable = bool(self.immutable_pattern and self.immutable_pattern.match(path.replace(os.sep, '/')))
+        fingerprint = QueryParams(scope.get("query_string", b"")).get("v") or None
+        return MediaFileResponse(str(full_path), stat_result, self.max_age, immutable, fingerprint)
+
+
+def asset_url(path: str, directory: str = "static", prefix: str = "/static") -> str:
+    """URL of a static asset fingerprinted with its content hash, e.g. for templates"""
+    try:
+        digest = digests.digest(os.path.join(directory, path))
+    except OSError:
+        return f"{prefix}/{path}"
+    return f"{prefix}/{path}?v={digest[:12]}"
@@ -0,0 +1,125 @@
+import bisect
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+# Relative weight of a match in each field of a video record
+FIELD_WEIGHTS = {
+    'title': 4,
+    'folder': 2,
+    'category': 2,
+    'description': 1,
+}
+
+_TOKEN_RE = re.compile(r'\w+')
+
+# Shorter query terms only match whole tokens: a one-letter prefix would
+# expand to a large part of the vocabulary
+MIN_PREFIX_LENGTH = 2
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercase, accent-free word tokens of a piece of text"""
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return _TOKEN_RE.findall(text)
+
+
+def video_terms(video: dict, folder_path: str) -> Dict[str, int]:
+    """Weighted tokens of a video: {token: sum of the weights of the fields containing it}"""
+    fields = {
+        'title': video.get('title'),
+        'folder': folder_path.replace('/', ' '),
+        'category': video.get('category'),
+        'description': video.get('description'),
+    }
+    terms = {}
+    for field, text in fields.items():
+        for token in set(tokenize(text)):
+            terms[token] = terms.get(token, 0) + FIELD_WEIGHTS[field]
+    return terms
+
+
+class SearchIndex:
+    """Inverted index over one user's videos with prefix matching.
+
+    Postings map each token to {video_id: weight}. The vocabulary is also
+    kept as a sorted list, so a query term expands to every token it is a
+    prefix of with one bisect and a short scan. Like FolderTree, the index
+    is maintained by VideoStore as records are put and deleted.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._vocabulary: List[str] = []
+        self._terms: Dict[str, Dict[str, int]] = {}
+
+    def __len__(self):
+        return len(self._terms)
+
+    def add(self, video_id: str, terms: Dict[str, int]):
+        self.remove(video_id)
+        self._terms[video_id] = terms
+        for token, weight in terms.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            postings[video_id] = weight
+
+    def remove(self, video_id: str):
+        terms = self._terms.pop(video_id, None)
+        if terms is None:
+            return
+        for token in terms:
+            postings = self._postings[token]
+            del postings[video_id]
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def _tokens(self, term: str) -> List[str]:
+        """Tokens a query term matches: those it is a prefix of, or itself if short"""
+        if len(term) < MIN_PREFIX_LENGTH:
+            return [term] if term in self._postings else []
+        start = end = bisect.bisect_left(self._vocabulary, term)
+        while end < len(self._vocabulary) and self._vocabulary[end].startswith(term):
+            end += 1
+        return self._vocabulary[start:end]
+
+    def _expand(self, term: str, tokens: List[str], candidates: Optional[dict] = None) -> Dict[str, int]:
+        """Score of every video matching a term; exact tokens count double"""
+        scores = {}
+        for token in tokens:
+            factor = 2 if token == term else 1
+            postings = self._postings[token]
+            if candidates is not None:
+                # Only videos matching the earlier terms can still match; the
+                # key view intersection walks the smaller side
+                postings = {video_id: postings[video_id] for video_id in postings.keys() & candidates.keys()}
+            if not scores:
+                scores = {video_id: weight * factor for video_id, weight in postings.items()}
+                continue
+            for video_id, weight in postings.items():
+                score = weight * factor
+                if score > scores.get(video_id, 0):
+                    scores[video_id] = score
+        return scores
+
+    def search(self, query: str) -> Dict[str, int]:
+        """{video_id: score} of the videos matching every query term"""
+        terms = [(term, self._tokens(term)) for term in set(tokenize(query))]
+        # Narrowest terms first, so the broad ones only check their candidates
+        terms.sort(key=lambda item: sum(len(self._postings[token]) for token in item[1]))
+        results = None
+        for term, tokens in terms:
+            scores = self._expand(term, tokens, results)
+            if results is None:
+                results = scores
+            else:
+                results = {video_id: results[video_id] + score for video_id, score in scores.items()}
+            if not results:
+                return {}
+        return results or {}
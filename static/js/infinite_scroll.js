@@ -0,0 +1,41 @@
+// Infinite scroll for video grids backed by /api/videos keyset pagination
+
+function escapeHtml(value) {
+    return String(value ?? '').replace(/[&<>"']/g, ch => ({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+    })[ch]);
+}
+
+// Append pages to `grid` while the sentinel after it is visible.
+// `params` are extra query parameters (folder, recursive) and
+// `renderCard(video)` returns the HTML of one card.
+function setupInfiniteScroll(grid, nextCursor, params, renderCard) {
+    if (!grid || !nextCursor) return;
+
+    const sentinel = document.createElement('div');
+    sentinel.className = 'scroll-sentinel';
+    grid.after(sentinel);
+
+    let loading = false;
+    const observer = new IntersectionObserver(async entries => {
+        if (!entries[0].isIntersecting || loading || !nextCursor) return;
+        loading = true;
+        try {
+            const query = new URLSearchParams({ ...params, cursor: nextCursor });
+            const response = await fetch(`/api/videos?${query}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const data = await response.json();
+            grid.insertAdjacentHTML('beforeend', data.videos.map(renderCard).join(''));
+            nextCursor = data.next_cursor;
+        } catch (error) {
+            console.error('Error loading more videos:', error);
+        } finally {
+            loading = false;
+        }
+        if (!nextCursor) {
+            observer.disconnect();
+            sentinel.remove();
+        }
+    }, { rootMargin: '600px' });
+    observer.observe(sentinel);
+}
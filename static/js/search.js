@@ -0,0 +1,52 @@
+// Live search backed by the /api/search inverted index
+
+// Show results of `input`'s query in place of `grid` while it is non-empty.
+// `params` are extra query parameters (folder) and `renderCard(video)`
+// returns the HTML of one card, as for setupInfiniteScroll.
+function setupLiveSearch(input, grid, params, renderCard) {
+    if (!input || !grid) return;
+
+    const results = document.createElement('div');
+    results.className = grid.className;
+    results.style.display = 'none';
+    grid.before(results);
+
+    let timer = null;
+    let latest = 0;
+
+    function showGrid(visible) {
+        grid.style.display = visible ? '' : 'none';
+        const sentinel = grid.nextElementSibling;
+        if (sentinel && sentinel.classList.contains('scroll-sentinel')) {
+            sentinel.style.display = visible ? '' : 'none';
+        }
+        results.style.display = visible ? 'none' : '';
+    }
+
+    async function run(query) {
+        const request = ++latest;
+        try {
+            const response = await fetch(`/api/search?${new URLSearchParams({ ...params, q: query })}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const data = await response.json();
+            if (request !== latest) return;  // A newer query is in flight
+            results.innerHTML = data.videos.length
+                ? data.videos.map(renderCard).join('')
+                : '<p style="color: var(--text-secondary);">No videos match your search.</p>';
+            showGrid(false);
+        } catch (error) {
+            console.error('Error searching videos:', error);
+        }
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const query = this.value.trim();
+        if (!query) {
+            latest++;
+            showGrid(true);
+            return;
+        }
+        timer = setTimeout(() => run(query), 150);
+    });
+}
@@ -0,0 +1,37 @@
+// Video card thumbnails with resized WebP/JPEG variants (see thumbnail_derivatives.py).
+// Loaded in <head>, after the page sets window.THUMBNAIL_WIDTHS, so that
+// thumbnailError exists before any image can fail.
+
+const THUMBNAIL_PLACEHOLDER = 'https://via.placeholder.com/300x180?text=No+Image';
+const THUMBNAIL_SIZES = '(max-width: 480px) 100vw, 360px';  // Same as GRID_SIZES
+
+function thumbnailUrl(video) {
+    const path = video.thumbnail_path || '';
+    return path.includes('thumbnails') ? '/' + path : `https://img.youtube.com/vi/${video.video_id}/hqdefault.jpg`;
+}
+
+// srcset of the resized variants of a content-addressed thumbnail, or ''
+function thumbnailSrcset(video, ext) {
+    const match = (video.thumbnail_path || '').match(/(?:^|\/)([0-9a-f]{32})\.\w+$/);
+    const widths = window.THUMBNAIL_WIDTHS || [];
+    if (!match || !widths.length) return '';
+    return widths.map(width => `/thumbs/${width}/${match[1]}.${ext} ${width}w`).join(', ');
+}
+
+// <picture> markup of a video card thumbnail, as rendered by the templates
+function thumbnailHtml(video) {
+    const srcset = thumbnailSrcset(video, 'jpg');
+    const webp = srcset
+        ? `<source type="image/webp" srcset="${thumbnailSrcset(video, 'webp')}" sizes="${THUMBNAIL_SIZES}">`
+        : '';
+    const responsive = srcset ? ` srcset="${srcset}" sizes="${THUMBNAIL_SIZES}"` : '';
+    return `<picture>${webp}<img src="${escapeHtml(thumbnailUrl(video))}"${responsive} alt="${escapeHtml(video.title)}" loading="lazy" onerror="thumbnailError(this)"></picture>`;
+}
+
+// Replace a thumbnail that failed to load, variants included, with a placeholder
+function thumbnailError(img) {
+    img.onerror = null;
+    img.parentNode.querySelectorAll('source').forEach(source => source.remove());
+    img.removeAttribute('srcset');
+    img.src = THUMBNAIL_PLACEHOLDER;
+}
@@ -0,0 +1,579 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import config
+from locks import FileLock
+
+VIDEO_DB = "video_db.json"
+FOLDER_DB = "folder_db.json"
+USERS_DB = "users_db.json"
+
+
+def video_folder(video: dict) -> str:
+    """Folder path of a video record (older records only carry folder_name)"""
+    return video.get('folder_path', video.get('folder_name', ''))
+
+
+def video_source(video: dict) -> str:
+    """Source type of a video record (records without one are YouTube links)"""
+    return video.get('source_type', 'youtube')
+
+
+def read_json(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_json(path: str, data: dict):
+    """Write a JSON file atomically so a crash never leaves it half written"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def apply_op(videos: Dict[str, dict], folders: Dict[str, dict], op: dict):
+    """Apply one catalog operation to plain video and folder dicts"""
+    kind = op['op']
+    if kind == 'put_video':
+        videos[op['key']] = op['value']
+    elif kind == 'del_video':
+        videos.pop(op['key'], None)
+    elif kind == 'put_folder':
+        folders[op['key']] = op['value']
+    elif kind == 'del_folder':
+        folders.pop(op['key'], None)
+
+
+class JsonBackend:
+    """The original whole-file JSON storage, fine for small installs.
+
+    video_db.json and folder_db.json are snapshots: they are read by
+    load_catalog() and only rewritten by compaction. Catalog operations are
+    appended as one JSON line per batch to a write-ahead log, so a write
+    costs the same no matter how large the catalog is; the log is replayed
+    on top of the snapshots on load and a torn last line from a crash is
+    dropped. Batches always carry full records, which makes replaying a log
+    over a newer snapshot harmless.
+
+    users_db.json is rewritten on every save, with just the changed
+    entries merged into what is on disk, as are the per-channel sync
+    checkpoints in sync_checkpoints.json.
+
+    For several worker processes, writers hold locked(), a file lock, and
+    bump a per-collection generation counter kept in
+    store_generation.json. A worker whose counter is behind reads the log
+    lines appended since its last position, continuing into the new log
+    if a compaction rotated it in the meantime; only when the rotated log
+    was already folded into the snapshots does it reload everything.
+    """
+
+    name = 'json'
+
+    def __init__(self, video_path: str = VIDEO_DB, folder_path: str = FOLDER_DB,
+                 log_path: str = config.STORE_LOG_FILE, fsync: bool = config.STORE_FSYNC,
+                 users_path: str = USERS_DB,
+                 checkpoint_path: str = config.SYNC_CHECKPOINT_FILE,
+                 generation_path: str = config.STORE_GENERATION_FILE):
+        self.video_path = video_path
+        self.folder_path = folder_path
+        self.log_path = log_path
+        self.fsync = fsync
+        self.users_path = users_path
+        self.checkpoint_path = checkpoint_path
+        self.generation_path = generation_path
+        self._file_lock = FileLock(f"{log_path}.lock")
+        self._log = None
+        self._log_position = (0, 0)  # (rotation, offset) of the log read so far
+        self.log_records = 0
+        self.last_compacted = time.monotonic()
+
+    @property
+    def _old_log_path(self) -> str:
+        return f"{self.log_path}.old"
+
+    # Cross-process coordination
+
+    def locked(self) -> FileLock:
+        """Lock held around every write, shared with the other worker processes"""
+        return self._file_lock
+
+    def generation(self, name: str) -> int:
+        """Change counter of 'catalog', 'users' or 'log' (log rotations)"""
+        return read_json(self.generation_path).get(name, 0)
+
+    def _bump_generation(self, name: str, step: int = 1) -> int:
+        generations = read_json(self.generation_path)
+        generations[name] = generations.get(name, 0) + step
+        # Not fsynced: after a crash every worker starts from a full load anyway
+        tmp_path = f"{self.generation_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(generations, f)
+        os.replace(tmp_path, self.generation_path)
+        return generations[name]
+
+    # Catalog
+
+    def load_catalog(self) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+        """Videos and folders from the snapshots with the log replayed on top"""
+        with self._file_lock:
+            self.close()
+            videos = read_json(self.video_path)
+            folders = read_json(self.folder_path)
+            self.log_records = (self._replay(self._old_log_path, videos, folders) +
+                                self._replay(self.log_path, videos, folders))
+            size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            self._log_position = (self.generation('log'), size)
+            return videos, folders
+
+    def changes_since(self, generation: int) -> Optional[List[dict]]:
+        """Operations other processes logged since our last read, or None to reload.
+
+        Called with locked() held, when generation('catalog') has moved on.
+        """
+        rotation, offset = self._log_position
+        current = self.generation('log')
+        ops = []
+        if current == rotation + 1:
+            # Rotated by a compaction: finish the old log, then read the new one whole
+            if self._read_ops(self._old_log_path, offset, ops) is None:
+                return None  # Already folded into the snapshots
+            offset = 0
+        elif current != rotation:
+            return None
+        end = self._read_ops(self.log_path, offset, ops)
+        if end is None:
+            if offset:
+                return None
+            end = 0  # Nothing logged since the rotation
+        self._log_position = (current, end)
+        return ops
+
+    def _read_ops(self, path: str, offset: int, ops: List[dict]) -> Optional[int]:
+        """Add the operations logged in a file after offset to ops.
+
+        Returns the offset read up to, or None if the file is missing or
+        ends in a torn line.
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return None
+                ops.extend(json.loads(line))
+                self.log_records += 1
+            return f.tell()
+
+    def _replay(self, path: str, videos: dict, folders: dict) -> int:
+        """Apply every complete record of a log file, truncating a torn tail"""
+        if not os.path.exists(path):
+            return 0
+        records = 0
+        valid_size = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    ops = json.loads(line)
+                except ValueError:
+                    break
+                for op in ops:
+                    apply_op(videos, folders, op)
+                records += 1
+                valid_size += len(line)
+        if valid_size != os.path.getsize(path):
+            print(f"Discarding torn tail of {path} after {records} records")
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+        return records
+
+    def append(self, ops: List[dict]) -> int:
+        """Durably record a batch of operations as one log line, returning the new generation"""
+        with self._file_lock:
+            if self._log is not None and not self._is_current_log(self._log):
+                self.close()  # Another worker rotated the log
+            if self._log is None:
+                self._log = open(self.log_path, 'a')
+                self._log_rotation = self.generation('log')
+            self._log.write(json.dumps(ops) + '\n')
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self.log_records += 1
+            self._log_position = (self._log_rotation, self._log.tell())
+            return self._bump_generation('catalog')
+
+    def _is_current_log(self, f) -> bool:
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def needs_compaction(self, interval: float, threshold: int) -> bool:
+        if self.log_records >= threshold:
+            return True
+        return self.log_records > 0 and time.monotonic() - self.last_compacted >= interval
+
+    def begin_compaction(self) -> bool:
+        """Rotate the log to <log>.old; returns False if there is nothing to fold.
+
+        Called under the store lock and locked(). The snapshots are then written by
+        finish_compaction() while writers keep appending to the new log. If
+        the process dies before .old is removed, the next load replays it
+        over whichever snapshots made it to disk.
+        """
+        if not self.log_records and not os.path.exists(self._old_log_path):
+            return False
+        self.close()
+        if os.path.exists(self.log_path):
+            if os.path.exists(self._old_log_path):
+                # A previous compaction failed part way: keep both logs. Offsets
+                # into the old log no longer line up, so other workers reload
+                with open(self._old_log_path, 'ab') as old, open(self.log_path, 'rb') as current:
+                    old.write(current.read())
+                os.remove(self.log_path)
+                rotation = self._bump_generation('log', 2)
+            else:
+                os.replace(self.log_path, self._old_log_path)
+                rotation = self._bump_generation('log')
+            self._log_position = (rotation, 0)
+        self.log_records = 0
+        self.last_compacted = time.monotonic()
+        return True
+
+    def finish_compaction(self, videos: dict, folders: dict):
+        write_json(self.video_path, videos)
+        write_json(self.folder_path, folders)
+        with self._file_lock:  # Not while another worker is replaying it
+            if os.path.exists(self._old_log_path):
+                os.remove(self._old_log_path)
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    # Users and sync checkpoints
+
+    def load_users(self) -> Optional[Dict[str, dict]]:
+        """All users, or None if none were ever saved"""
+        if not os.path.exists(self.users_path):
+            return None
+        return read_json(self.users_path)
+
+    def _merge_into(self, path: str, data: Dict[str, dict], changed: Iterable[str]):
+        """Write the changed entries of data over the file's current contents"""
+        current = read_json(path)
+        for key in changed:
+            if key in data:
+                current[key] = data[key]
+            else:
+                current.pop(key, None)
+        write_json(path, current)
+
+    def save_users(self, users: Dict[str, dict], changed: Iterable[str]) -> int:
+        with self._file_lock:
+            self._merge_into(self.users_path, users, changed)
+            return self._bump_generation('users')
+
+    def load_sync_checkpoints(self) -> Dict[str, int]:
+        """Highest message id synced from each channel"""
+        return read_json(self.checkpoint_path)
+
+    def save_sync_checkpoints(self, checkpoints: Dict[str, int]):
+        """Save the checkpoints of the given channels"""
+        with self._file_lock:
+            self._merge_into(self.checkpoint_path, checkpoints, checkpoints)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    folder_path TEXT,
+    added_time TEXT,
+    source_type TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS videos_user_id ON videos (user_id);
+CREATE INDEX IF NOT EXISTS videos_folder_path ON videos (folder_path);
+CREATE INDEX IF NOT EXISTS videos_added_time ON videos (added_time);
+CREATE INDEX IF NOT EXISTS videos_source_type ON videos (source_type);
+
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    user_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS folders_user_id ON folders (user_id);
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_checkpoints (
+    channel_id TEXT PRIMARY KEY,
+    last_message_id INTEGER NOT NULL
+);
+
+-- Catalog operation batches by generation, read by the other worker processes
+CREATE TABLE IF NOT EXISTS changes (
+    generation INTEGER PRIMARY KEY,
+    ops TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SqliteBackend:
+    """SQLite storage in WAL mode, safe to share between worker processes.
+
+    Every batch of catalog operations and every users or checkpoint save
+    is one IMMEDIATE transaction, so concurrent writers serialize on the
+    database lock instead of overwriting each other's files, and readers
+    never see half of a batch. Only the rows named as changed are written,
+    so two processes updating different users no longer lose each other's
+    updates. Records are stored as JSON next to the columns they are
+    queried by.
+
+    Each save also bumps a generation counter in meta. Catalog batches are
+    kept in the changes table under their generation, so a worker that is
+    behind applies just the batches it missed; it reloads everything only
+    if it fell further behind than STORE_CHANGE_RETENTION batches.
+
+    The first time a database is opened, the existing JSON files (and any
+    JSON store log) are imported into it in one transaction. The JSON
+    files are left in place and not read again.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = config.SQLITE_DB_FILE, fsync: bool = config.STORE_FSYNC,
+                 change_retention: int = config.STORE_CHANGE_RETENTION):
+        self.path = path
+        self.fsync = fsync
+        self.change_retention = change_retention
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(f"{path}.lock")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+                conn.executescript(SQLITE_SCHEMA)
+                self._conn = conn
+                if not self._migrated(conn):
+                    try:
+                        self.migrate_from_json(JsonBackend())
+                    except BaseException:
+                        self.close()
+                        raise
+            return self._conn
+
+    @staticmethod
+    def _migrated(conn: sqlite3.Connection) -> bool:
+        return conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone() is not None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # Cross-process coordination
+
+    def locked(self) -> FileLock:
+        """Lock held around every catalog write, shared with the other worker processes"""
+        return self._file_lock
+
+    def generation(self, name: str) -> int:
+        """Change counter of 'catalog' or 'users'"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM meta WHERE key = ?", (f"generation:{name}",)).fetchone()
+        return int(row[0]) if row else 0
+
+    @staticmethod
+    def _bump_generation(conn: sqlite3.Connection, name: str) -> int:
+        key = f"generation:{name}"
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        generation = (int(row[0]) if row else 0) + 1
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(generation)))
+        return generation
+
+    def changes_since(self, generation: int) -> Optional[List[dict]]:
+        """Operations saved after the given catalog generation, or None to reload"""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT generation, ops FROM changes WHERE generation > ? ORDER BY generation",
+                (generation,)).fetchall()
+        if not rows or rows[0][0] != generation + 1:
+            return None  # Pruned already
+        ops = []
+        for _, batch in rows:
+            ops.extend(json.loads(batch))
+        return ops
+
+    def migrate_from_json(self, source: JsonBackend):
+        """One-shot import of the JSON files into an empty database"""
+        videos, folders = source.load_catalog()
+        users = source.load_users() or {}
+        checkpoints = source.load_sync_checkpoints()
+        with self._transaction() as conn:
+            if self._migrated(conn):
+                return  # Another worker process got there first
+            self._write_ops(conn, [{'op': 'put_video', 'key': video_id, 'value': video}
+                                   for video_id, video in videos.items()])
+            self._write_ops(conn, [{'op': 'put_folder', 'key': path, 'value': folder}
+                                   for path, folder in folders.items()])
+            self._write_users(conn, users, users)
+            self._write_checkpoints(conn, checkpoints)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                         (time.strftime('%Y-%m-%dT%H:%M:%S'),))
+        if videos or folders or users:
+            print(f"Migrated {len(videos)} videos, {len(folders)} folders and {len(users)} users "
+                  f"from JSON into {self.path}")
+
+    # Catalog
+
+    def load_catalog(self) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")  # One snapshot for both tables
+            try:
+                videos = {video_id: json.loads(data)
+                          for video_id, data in conn.execute("SELECT video_id, data FROM videos")}
+                folders = {path: json.loads(data)
+                           for path, data in conn.execute("SELECT path, data FROM folders")}
+            finally:
+                conn.execute("COMMIT")
+        return videos, folders
+
+    @staticmethod
+    def _write_ops(conn: sqlite3.Connection, ops: List[dict]):
+        for op in ops:
+            kind = op['op']
+            if kind == 'put_video':
+                video = op['value']
+                conn.execute(
+                    "INSERT OR REPLACE INTO videos (video_id, user_id, folder_path, added_time, source_type, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (op['key'], video.get('user_id'), video_folder(video), str(video.get('added_time', '')),
+                     video_source(video), json.dumps(video)))
+            elif kind == 'del_video':
+                conn.execute("DELETE FROM videos WHERE video_id = ?", (op['key'],))
+            elif kind == 'put_folder':
+                conn.execute("INSERT OR REPLACE INTO folders (path, user_id, data) VALUES (?, ?, ?)",
+                             (op['key'], op['value'].get('user_id'), json.dumps(op['value'])))
+            elif kind == 'del_folder':
+                conn.execute("DELETE FROM folders WHERE path = ?", (op['key'],))
+
+    def append(self, ops: List[dict]) -> int:
+        """Save a batch of operations in one transaction, returning the new generation"""
+        with self._transaction() as conn:
+            self._write_ops(conn, ops)
+            generation = self._bump_generation(conn, 'catalog')
+            conn.execute("INSERT INTO changes (generation, ops) VALUES (?, ?)", (generation, json.dumps(ops)))
+            conn.execute("DELETE FROM changes WHERE generation <= ?", (generation - self.change_retention,))
+        return generation
+
+    def needs_compaction(self, interval: float, threshold: int) -> bool:
+        return False
+
+    def begin_compaction(self) -> bool:
+        return False
+
+    def finish_compaction(self, videos: dict, folders: dict):
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # Users and sync checkpoints
+
+    def load_users(self) -> Optional[Dict[str, dict]]:
+        with self._lock:
+            rows = self._connection().execute("SELECT username, data FROM users").fetchall()
+        if not rows:
+            return None
+        return {username: json.loads(data) for username, data in rows}
+
+    @staticmethod
+    def _write_users(conn: sqlite3.Connection, users: Dict[str, dict], changed: Iterable[str]):
+        for username in changed:
+            if username in users:
+                conn.execute("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                             (username, json.dumps(users[username])))
+            else:
+                conn.execute("DELETE FROM users WHERE username = ?", (username,))
+
+    def save_users(self, users: Dict[str, dict], changed: Iterable[str]) -> int:
+        with self._transaction() as conn:
+            self._write_users(conn, users, changed)
+            return self._bump_generation(conn, 'users')
+
+    def load_sync_checkpoints(self) -> Dict[str, int]:
+        """Highest message id synced from each channel"""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT channel_id, last_message_id FROM sync_checkpoints").fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _write_checkpoints(conn: sqlite3.Connection, checkpoints: Dict[str, int]):
+        conn.executemany("INSERT OR REPLACE INTO sync_checkpoints (channel_id, last_message_id) VALUES (?, ?)",
+                         checkpoints.items())
+
+    def save_sync_checkpoints(self, checkpoints: Dict[str, int]):
+        """Save the checkpoints of the given channels"""
+        with self._transaction() as conn:
+            self._write_checkpoints(conn, checkpoints)
+
+
+BACKENDS = {
+    'json': JsonBackend,
+    'sqlite': SqliteBackend,
+}
+
+
+def open_backend(name: str = config.STORAGE_BACKEND):
+    """Storage backend selected by STORAGE_BACKEND ('json' or 'sqlite')"""
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {name!r} (expected one of {', '.join(BACKENDS)})")
+
+
+backend = open_backend()
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import config
+
+
+def stream_url_expiry(stream_url: str, now: float, default_ttl: float = config.STREAM_CACHE_TTL,
+                      margin: float = config.STREAM_CACHE_MARGIN) -> float:
+    """When a cached stream URL should be considered stale.
+
+    Signed googlevideo URLs carry their lifetime in an ``expire`` query
+    parameter (unix time); other URLs fall back to default_ttl.
+    """
+    expire = parse_qs(urlparse(stream_url).query).get('expire')
+    if expire:
+        try:
+            return min(float(expire[0]) - margin, now + default_ttl)
+        except ValueError:
+            pass
+    return now + default_ttl
+
+
+class StreamCache:
+    """Cache of resolved stream info keyed by (video_id, format).
+
+    Lookups that miss share a single in-flight resolution: concurrent
+    viewers of the same video await the same task instead of each running
+    their own extraction. Only results carrying a stream_url are cached.
+    """
+
+    def __init__(self, max_entries: int = config.STREAM_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, str], Tuple[dict, float]] = {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def get_cached(self, key: Tuple[str, str]) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        return entry[0]
+
+    async def get(self, key: Tuple[str, str], resolve: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        cached = self.get_cached(key)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve(key, resolve))
+            self._inflight[key] = task
+        # Shield so one cancelled request doesn't cancel the others waiting on it
+        return await asyncio.shield(task)
+
+    async def _resolve(self, key, resolve) -> Optional[dict]:
+        try:
+            result = await resolve()
+            if result and result.get('stream_url'):
+                self.put(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def put(self, key: Tuple[str, str], result: dict):
+        now = time.time()
+        expires_at = stream_url_expiry(result['stream_url'], now)
+        if expires_at <= now:
+            return
+        if len(self._entries) >= self.max_entries:
+            self._evict(now)
+        self._entries[key] = (result, expires_at)
+
+    def _evict(self, now: float):
+        for key in [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
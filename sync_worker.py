@@ -1,35 +1,187 @@
-import json
 import asyncio
+import random
+import sys
+import time
 import config
-from telegram_client import fetch_all_videos
+from ingest_queue import IngestQueue, RetryableJobError
+from storage import backend
+from telegram_client import telegram
+from telegram_ingest import ingest_channel
+from video_store import store
+from worker_pool import io_pool
 
-def load_cache():
-    try:
-        with open(config.VIDEO_CACHE_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-def save_cache(cache):
-    with open(config.VIDEO_CACHE_FILE, 'w') as f:
-        json.dump(cache, f, indent=2)
-
-async def sync_videos():
-    cache = load_cache()
-    new_videos = await fetch_all_videos()
-    updated = False
-    for video in new_videos:
-        vid = video['unique_video_id']
-        if vid not in cache:
-            cache[vid] = video
-            updated = True
-    if updated:
-        save_cache(cache)
-        print(f"Synced {len(new_videos)} videos, total in cache: {len(cache)}")
+async def sync_channel(channel, full=False):
+    """Ingest a channel's messages posted since its checkpoint into the video store.
+
+    With full=True the channel is walked from its first message, ignoring
+    the checkpoint: stored videos are refreshed from Telegram and ones whose
+    message no longer exists are dropped. Use it to repair the store.
+    Returns the number of videos stored, or None if the fetch failed (the
+    checkpoint is then left alone, so nothing is skipped).
+    """
+    channel = channel.strip()
+    checkpoint = (await io_pool.run(backend.load_sync_checkpoints)).get(channel, 0)
+    result = await ingest_channel(channel, checkpoint, full)
+    if result is None:
+        return None
+    stored, last_message_id = result
+    if last_message_id != checkpoint:
+        await io_pool.run(backend.save_sync_checkpoints, {channel: last_message_id})
+    return stored
+
+async def sync_videos(full=False):
+    """Sync every configured channel, at most TELEGRAM_FETCH_CONCURRENCY at a time"""
+    semaphore = asyncio.Semaphore(config.TELEGRAM_FETCH_CONCURRENCY)
+    async def sync(channel):
+        async with semaphore:
+            return await sync_channel(channel, full)
+    results = await asyncio.gather(*(sync(channel) for channel in config.CHANNELS))
+    stored = sum(result for result in results if result)
+    if stored:
+        print(f"Synced {stored} videos from {len(config.CHANNELS)} channels")
     else:
         print("No new videos found.")
 
-async def periodic_sync():
-    while True:
-        await sync_videos()
-        await asyncio.sleep(config.SYNC_INTERVAL)
\ No newline at end of file
+class SyncScheduler:
+    """Syncs each channel on its own schedule, several channels at a time.
+
+    Every channel has its own interval (CHANNEL_SYNC_INTERVALS, else
+    SYNC_INTERVAL) and next-run time, jittered by SYNC_JITTER. Due channels
+    are synced concurrently, at most concurrency at once, so a slow channel
+    only holds up its own schedule. A channel whose previous run is still
+    going when it comes due again is skipped until its next turn. Run
+    counts, durations and stored video counts are kept per channel for
+    the admin stats.
+    """
+
+    def __init__(self, channels=None, intervals=None, default_interval=config.SYNC_INTERVAL,
+                 jitter=config.SYNC_JITTER, concurrency=config.TELEGRAM_FETCH_CONCURRENCY):
+        self.intervals = config.CHANNEL_SYNC_INTERVALS if intervals is None else intervals
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.channels = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running = {}
+        self._task = None
+        for channel in config.CHANNELS if channels is None else channels:
+            self._state(channel.strip())
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _state(self, channel):
+        state = self.channels.get(channel)
+        if state is None:
+            interval = self.intervals.get(channel, self.default_interval)
+            state = self.channels[channel] = {
+                'interval': interval,
+                # First runs are spread over the jitter window rather than all at startup
+                'next_run': time.monotonic() + random.uniform(0, interval * self.jitter),
+                'runs': 0,
+                'failures': 0,
+                'skipped': 0,
+                'last_started': None,
+                'last_duration': None,
+                'last_stored': None,
+                'total_stored': 0,
+            }
+        return state
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._running.values():
+            task.cancel()
+
+    async def _loop(self):
+        while self.channels:
+            now = time.monotonic()
+            for channel, state in self.channels.items():
+                if state['next_run'] <= now:
+                    self.run_now(channel)
+                    state['next_run'] = now + self._jittered(state['interval'])
+            next_run = min(state['next_run'] for state in self.channels.values())
+            await asyncio.sleep(max(next_run - time.monotonic(), 0))
+
+    def run_now(self, channel, full=False):
+        """Start syncing a channel unless it is already syncing; returns whether it started.
+
+        Only configured channels can be synced (ValueError otherwise).
+        """
+        channel = channel.strip()
+        state = self.channels.get(channel)
+        if state is None:
+            raise ValueError(f"Not a configured channel: {channel}")
+        if channel in self._running:
+            state['skipped'] += 1
+            return False
+        task = asyncio.create_task(self._run(channel, state, full))
+        self._running[channel] = task
+        task.add_done_callback(lambda _: self._running.pop(channel, None))
+        return True
+
+    async def _run(self, channel, state, full):
+        async with self._slots:
+            started = time.monotonic()
+            state['last_started'] = time.time()
+            try:
+                stored = await sync_channel(channel, full)
+            except Exception as e:
+                print(f"Error syncing {channel}: {e}")
+                stored = None
+            state['runs'] += 1
+            state['last_duration'] = round(time.monotonic() - started, 3)
+            state['last_stored'] = stored
+            if stored is None:
+                state['failures'] += 1
+            else:
+                state['total_stored'] += stored
+                if stored:
+                    print(f"Synced {stored} videos from {channel} in {state['last_duration']}s")
+
+    def stats(self):
+        now = time.monotonic()
+        return {channel: dict({key: value for key, value in state.items() if key != 'next_run'},
+                              running=channel in self._running,
+                              next_run_in=round(max(state['next_run'] - now, 0), 1))
+                for channel, state in self.channels.items()}
+
+scheduler = SyncScheduler()
+
+async def run_sync_job(job, final_attempt):
+    """Sync queue handler: start a requested sync in the leader's scheduler.
+
+    A sync requested while the channel is already syncing is covered by
+    that run, but a full resync is not: it is retried until the running
+    sync has finished.
+    """
+    channel = job['params']['channel']
+    full = job['params']['full']
+    started = scheduler.run_now(channel, full=full)
+    if full and not started:
+        raise RetryableJobError(f"{channel} is already syncing")
+    return {'channel': channel, 'started': started}
+
+async def submit_sync(channel, user_id, full=False):
+    """Ask the leader to sync a channel now, or return the request already pending"""
+    channel = channel.strip()
+    return await sync_queue.submit('resync' if full else 'sync', user_id, channel, channel=channel, full=full)
+
+# Manual syncs, requested in any worker, are run by the leader's scheduler
+sync_queue = IngestQueue(path=config.SYNC_JOBS_FILE, workers=1, max_attempts=config.SYNC_JOB_MAX_ATTEMPTS)
+
+async def main(full=False):
+    store.load()
+    try:
+        await sync_videos(full=full)
+    finally:
+        await telegram.stop()
+        store.close()
+
+if __name__ == "__main__":
+    # python sync_worker.py [--full]
+    asyncio.run(main(full="--full" in sys.argv[1:]))
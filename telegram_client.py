@@ -1,82 +1,153 @@
 import asyncio
 import os
+import sqlite3
+import time
 from pyrogram import Client
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
 import config
 import json
 from datetime import datetime
+from locks import LeaderLock
+from thumbnails import thumbnail_cache
 
-async def get_client():
+_sessions = {}  # base -> (lock on this process's slot, held until exit, session name)
+
+def session_name(base):
+    """This worker process's Telegram session: base for the first worker, base_<n> for the others.
+
+    pyrogram keeps a session in an SQLite file that two processes must not
+    share, so each worker claims a numbered slot with a lock it holds for
+    its lifetime. A new slot starts as a copy of the first session (the
+    same authorization with its own database), so user accounts need not
+    log in again; bots without one log in with their token.
+    """
+    if base in _sessions:
+        return _sessions[base][1]
+    slot = 0
+    while True:
+        lock = LeaderLock(f"{base}.{slot}.lock")
+        if lock.try_acquire():
+            break
+        slot += 1
+    name = base if slot == 0 else f"{base}_{slot}"
+    _sessions[base] = (lock, name)
+    if slot and not os.path.exists(f"{name}.session") and os.path.exists(f"{base}.session"):
+        # The backup API copies a consistent snapshot even while base is in use
+        source, target = sqlite3.connect(f"{base}.session"), sqlite3.connect(f"{name}.session")
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+    return name
+
+def get_client():
     if config.BOT_TOKEN:
         # Use bot client
         client = Client(
-            "bot_session",
+            session_name("bot_session"),
             api_id=config.API_ID,
             api_hash=config.API_HASH,
-            bot_token=config.BOT_TOKEN
+            bot_token=config.BOT_TOKEN,
+            sleep_threshold=config.TELEGRAM_SLEEP_THRESHOLD
         )
     else:
         # Use user client
         client = Client(
-            config.SESSION_FILE,
+            session_name(config.SESSION_FILE),
             api_id=config.API_ID,
-            api_hash=config.API_HASH
+            api_hash=config.API_HASH,
+            sleep_threshold=config.TELEGRAM_SLEEP_THRESHOLD
         )
-    await client.start()
     return client
 
-async def fetch_videos_from_channel(channel_id):
-    client = await get_client()
-    videos = []
-    try:
-        chat = await client.get_chat(channel_id)
-        channel_name = chat.title
-        async for message in client.get_chat_history(channel_id):
-            if message.video:
-                video = message.video
-                unique_id = f"{channel_id}_{message.id}"
-                thumbnail_path = await download_thumbnail_if_needed(client, video.thumbnail, unique_id)
-                data = {
-                    'unique_video_id': unique_id,
-                    'message_id': message.id,
-                    'channel_id': channel_id,
-                    'channel_name': channel_name,
-                    'title': message.caption or video.file_name or f"Video {message.id}",
-                    'description': message.caption,
-                    'stream_url': f"/stream/{video.file_id}",
-                    'thumbnail_path': thumbnail_path,
-                    'file_size': video.file_size,
-                    'duration': video.duration,
-                    'mime_type': video.mime_type,
-                    'views_count': 0,
-                    'category': '',
-                    'added_time': message.date.timestamp(),
-                    'last_updated': message.date.timestamp()
-                }
-                videos.append(data)
-    except Exception as e:
-        print(f"Error fetching from {channel_id}: {e}")
-    finally:
-        await client.stop()
-    return videos
-
-async def download_thumbnail_if_needed(client, thumbnail, unique_id):
+class TelegramClientManager:
+    """One long-lived Telegram client shared by sync, thumbnails and streaming.
+
+    The client is started once (at app startup, or on first use) instead of
+    doing a full session handshake per channel fetch. run() executes a call
+    against it: a dropped connection restarts the client and retries, and a
+    FloodWait longer than pyrogram's own sleep_threshold pauses every caller
+    until Telegram allows requests again, then retries.
+    """
+
+    def __init__(self, max_attempts: int = config.TELEGRAM_MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._client = None
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+
+    async def start(self):
+        await self.client()
+
+    async def client(self):
+        """The running client, starting it if needed"""
+        async with self._lock:
+            if self._client is None or not self._client.is_connected:
+                if self._client is not None:
+                    await self._stop_quietly()
+                client = get_client()
+                await client.start()
+                self._client = client
+            return self._client
+
+    async def _stop_quietly(self):
+        try:
+            await self._client.stop()
+        except Exception:
+            pass
+        self._client = None
+
+    async def restart(self):
+        async with self._lock:
+            if self._client is not None:
+                await self._stop_quietly()
+        return await self.client()
+
+    async def stop(self):
+        async with self._lock:
+            if self._client is not None:
+                await self._stop_quietly()
+
+    async def wait_for_flood(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self, call):
+        """await call(client), restarting on connection loss and waiting out flood limits"""
+        for attempt in range(1, self.max_attempts + 1):
+            await self.wait_for_flood()
+            client = await self.client()
+            try:
+                return await call(client)
+            except FloodWait as e:
+                if attempt == self.max_attempts:
+                    raise
+                print(f"Telegram flood wait of {e.value}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.value)
+            except (ConnectionError, OSError) as e:
+                if attempt == self.max_attempts:
+                    raise
+                print(f"Telegram connection lost ({e}), reconnecting")
+                await self.restart()
+
+telegram = TelegramClientManager()
+
+async def download_thumbnail_if_needed(thumbnail):
     if not thumbnail:
         return None
-    save_path = os.path.join(config.THUMBNAILS_DIR, f"{unique_id}.jpg")
-    if not os.path.exists(save_path):
-        await client.download_media(thumbnail.file_id, file=save_path)
+    source_key = f"tg:{thumbnail.file_unique_id}"
+    save_path = thumbnail_cache.lookup(source_key)
+    if not save_path:
+        data = await telegram.run(lambda client: client.download_media(thumbnail.file_id, in_memory=True))
+        save_path = await thumbnail_cache.store(source_key, bytes(data.getbuffer()))
     return save_path
 
-async def get_video_stream(client, file_id):
-    # This will be used in app.py for streaming
-    # But since client is per call, perhaps pass file_id and download on demand
-    pass
-
-# Function to get all videos from all channels
-async def fetch_all_videos():
-    all_videos = []
-    for channel in config.CHANNELS:
-        videos = await fetch_videos_from_channel(channel.strip())
-        all_videos.extend(videos)
-    return all_videos
\ No newline at end of file
+async def get_video_stream(file_id, offset=0, limit=0):
+    """Yield a media file's 1 MiB chunks, skipping offset chunks and stopping after limit (0 = all)"""
+    await telegram.wait_for_flood()
+    client = await telegram.client()
+    async for chunk in client.stream_media(file_id, limit=limit, offset=offset):
+        yield chunk
@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+import config
+from telegram_client import download_thumbnail_if_needed, telegram
+from transcoder import submit_transcode
+from video_store import store
+from worker_pool import PoolSaturated, io_pool
+
+# Fields a full resync refreshes from Telegram; views, folder and added time are kept
+TELEGRAM_FIELDS = ('title', 'description', 'thumbnail_path', 'duration', 'file_size',
+                   'mime_type', 'file_id', 'message_id', 'channel_id', 'source_url')
+
+
+def telegram_video_id(channel_id: str, message_id: int) -> str:
+    return f"{channel_id}_{message_id}"
+
+
+def telegram_record(message, channel_id: str, channel_name: str) -> dict:
+    """Video DB record of a Telegram message carrying a video"""
+    video = message.video
+    video_id = telegram_video_id(channel_id, message.id)
+    return {
+        'video_id': video_id,
+        'title': message.caption or video.file_name or f"Video {message.id}",
+        'description': message.caption or '',
+        'category': '',
+        'source_url': f"/api/telegram/download/{video_id}",
+        'folder_name': f"📱 {channel_name or 'Telegram'}",
+        'embed_url': f"/watch/{video_id}",
+        'thumbnail_path': '',
+        'duration': video.duration or 0,
+        'file_size': video.file_size or 0,
+        'mime_type': video.mime_type or 'video/mp4',
+        'added_time': datetime.now().isoformat(),
+        'views_count': 0,
+        'source_type': 'telegram',
+        'file_id': video.file_id,
+        'message_id': message.id,
+        'channel_id': channel_id,
+    }
+
+
+# Pipeline stages. Each one is an async generator pulling from the previous
+# stage, so at most one batch of messages is in memory at a time.
+
+async def channel_messages(client, channel_id: str, after: int, progress: dict) -> AsyncIterator:
+    """Messages newer than message id after, newest first.
+
+    progress['last_message_id'] is raised to the highest id seen.
+    """
+    async for message in client.get_chat_history(channel_id):
+        if message.id <= after:
+            return
+        progress['last_message_id'] = max(progress['last_message_id'], message.id)
+        yield message
+
+
+async def video_messages(messages: AsyncIterator, channel_id: str, refresh: bool) -> AsyncIterator:
+    """Messages with a video not yet in the store (or every one when refreshing)"""
+    async for message in messages:
+        if message.video and (refresh or not store.has_video(telegram_video_id(channel_id, message.id))):
+            yield message
+
+
+async def video_records(messages: AsyncIterator, channel_id: str, channel_name: str) -> AsyncIterator:
+    """(record, thumbnail) of each message"""
+    async for message in messages:
+        thumbs = message.video.thumbs
+        yield telegram_record(message, channel_id, channel_name), (thumbs[0] if thumbs else None)
+
+
+async def batched(items: AsyncIterator, size: int) -> AsyncIterator[list]:
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def with_thumbnails(batches: AsyncIterator[list]) -> AsyncIterator[List[dict]]:
+    """Download each batch's thumbnails concurrently and yield its records"""
+    semaphore = asyncio.Semaphore(config.THUMBNAIL_CONCURRENCY)
+
+    async def fetch(thumbnail):
+        async with semaphore:
+            return await download_thumbnail_if_needed(thumbnail)
+
+    async for batch in batches:
+        paths = await asyncio.gather(*(fetch(thumbnail) for _, thumbnail in batch), return_exceptions=True)
+        records = []
+        for (record, _), path in zip(batch, paths):
+            if isinstance(path, Exception):
+                print(f"Error downloading thumbnail for {record['video_id']}: {path}")
+            else:
+                record['thumbnail_path'] = path or ''
+            records.append(record)
+        yield records
+
+
+def _commit_batch(records: List[dict]) -> Tuple[int, List[str]]:
+    """Put a batch in the store, returning (records written, IDs of the new ones).
+
+    Records already in the store only get their Telegram fields refreshed.
+    """
+    videos = {}
+    new_ids = []
+    for record in records:
+        existing = store.get_video(record['video_id'])
+        if existing is None:
+            new_ids.append(record['video_id'])
+        else:
+            fields = {field: record[field] for field in TELEGRAM_FIELDS}
+            if not fields['thumbnail_path']:
+                fields['thumbnail_path'] = existing.get('thumbnail_path', '')
+            record = dict(existing, **fields)
+            if record == existing:
+                continue
+        videos[record['video_id']] = record
+    store.put_videos(videos)
+    return len(videos), new_ids
+
+
+def _remove_missing(channel_id: str, seen: set) -> int:
+    """Delete the channel's videos whose message was not seen by a full walk"""
+    return store.delete_videos([video['video_id'] for video in store.videos_by_source('telegram')
+                                if video.get('channel_id') == channel_id and video['video_id'] not in seen])
+
+
+async def _ingest(client, channel_id: str, after: int, full: bool) -> Tuple[int, int]:
+    chat = await client.get_chat(channel_id)
+    progress = {'last_message_id': after}
+    seen = set()
+    stored = 0
+    messages = video_messages(channel_messages(client, channel_id, after, progress), channel_id, full)
+    batches = batched(video_records(messages, channel_id, chat.title), config.TELEGRAM_INGEST_BATCH_SIZE)
+    async for records in with_thumbnails(batches):
+        seen.update(record['video_id'] for record in records)
+        written, new_ids = await io_pool.run(_commit_batch, records)
+        stored += written
+        if config.TRANSCODE_TELEGRAM:
+            for video_id in new_ids:
+                try:
+                    await submit_transcode(video_id, None)
+                except PoolSaturated:
+                    print(f"Transcode queue full, not transcoding {video_id}")
+    if full:
+        removed = await io_pool.run(_remove_missing, channel_id, seen)
+        if removed:
+            print(f"Removed {removed} videos deleted from {channel_id}")
+    return stored, progress['last_message_id']
+
+
+async def ingest_channel(channel_id: str, after: int = 0, full: bool = False) -> Optional[Tuple[int, int]]:
+    """Stream a channel's messages newer than message id after into the video store.
+
+    Messages flow through filter, transform, thumbnail and commit stages
+    in batches of TELEGRAM_INGEST_BATCH_SIZE, each batch stored as one
+    write. With full=True the whole history is walked: videos already
+    stored are refreshed and ones whose message was deleted are removed.
+
+    Returns (videos stored, highest message id seen), or None if the
+    channel could not be fetched. A walk interrupted by a lost connection
+    starts over; videos it already stored are skipped.
+    """
+    try:
+        return await telegram.run(lambda client: _ingest(client, channel_id, 0 if full else after, full))
+    except Exception as e:
+        print(f"Error fetching from {channel_id}: {e}")
+        return None
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+import config
+from worker_pool import io_pool
+
+# pyrogram's stream_media() always yields 1 MiB chunks (the last one may be shorter)
+CHUNK_SIZE = 1024 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) byte range of a Range header, or None to send everything.
+
+    Only single ranges are supported. Raises ValueError if the range cannot
+    be satisfied, which callers turn into a 416 response.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None  # Unsupported syntax (e.g. several ranges): fall back to the whole file
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            raise ValueError("Unsatisfiable range")
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+class ChunkCache:
+    """Disk cache of media chunks, evicting the least recently used past max_bytes.
+
+    Chunks live at <directory>/<sha256(file key)[:32]>/<index>. The index of
+    what is on disk (and its access order) is rebuilt from the directory on
+    first use and kept in memory.
+    """
+
+    def __init__(self, directory: str = config.TELEGRAM_CHUNK_CACHE_DIR,
+                 max_bytes: int = config.TELEGRAM_CHUNK_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._entries: Optional[OrderedDict] = None  # path -> size, least recently used first
+        self._total = 0
+
+    def _path(self, file_key: str, index: int) -> str:
+        digest = hashlib.sha256(file_key.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, digest, str(index))
+
+    def _index(self) -> OrderedDict:
+        if self._entries is None:
+            entries = []
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, path, stat.st_size))
+            entries.sort()
+            self._entries = OrderedDict((path, size) for _, path, size in entries)
+            self._total = sum(self._entries.values())
+        return self._entries
+
+    def get(self, file_key: str, index: int) -> Optional[bytes]:
+        path = self._path(file_key, index)
+        with self.lock:
+            entries = self._index()
+            if path not in entries:
+                return None
+            entries.move_to_end(path)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with self.lock:
+                self._forget(path)
+            return None
+
+    def put(self, file_key: str, index: int, data: bytes):
+        path = self._path(file_key, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            entries = self._index()
+            self._forget(path)
+            entries[path] = len(data)
+            self._total += len(data)
+            while self._total > self.max_bytes and len(entries) > 1:
+                old_path, _ = next(iter(entries.items()))
+                self._forget(old_path)
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+
+    def _forget(self, path: str):
+        size = self._index().pop(path, None)
+        if size is not None:
+            self._total -= size
+
+
+class MediaStreamer:
+    """Serves byte ranges of Telegram media from the chunk cache or Telegram.
+
+    Chunks missing from the cache are fetched in runs of up to readahead
+    chunks with one stream_media() call, holding one of concurrency
+    download slots, and written to the cache as they arrive. Concurrent
+    requests for the same run share one download.
+    """
+
+    def __init__(self, fetch: Callable[[str, int, int], AsyncIterator[bytes]],
+                 cache: Optional[ChunkCache] = None,
+                 concurrency: int = config.TELEGRAM_STREAM_CONCURRENCY,
+                 readahead: int = config.TELEGRAM_STREAM_READAHEAD):
+        self.fetch = fetch
+        self.cache = cache or ChunkCache()
+        self.readahead = readahead
+        self._slots = asyncio.Semaphore(concurrency)
+        self._in_flight: Dict[Tuple[str, int], Awaitable[list]] = {}
+
+    async def _cached(self, file_id: str, index: int) -> Optional[bytes]:
+        return await io_pool.run(self.cache.get, file_id, index)
+
+    async def _download(self, file_id: str, first: int, count: int) -> list:
+        async with self._slots:
+            chunks = []
+            async for chunk in self.fetch(file_id, first, count):
+                chunks.append(chunk)
+                await io_pool.run(self.cache.put, file_id, first + len(chunks) - 1, chunk)
+            return chunks
+
+    async def _run(self, file_id: str, first: int, count: int) -> list:
+        key = (file_id, first)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(file_id, first, count))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shielded so one client disconnecting does not cancel a shared download
+        return await asyncio.shield(task)
+
+    async def iter_range(self, file_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Yield the bytes start..end (inclusive) of a media file"""
+        index = start // CHUNK_SIZE
+        last = end // CHUNK_SIZE
+        while index <= last:
+            data = await self._cached(file_id, index)
+            chunks = [data] if data is not None else await self._run(
+                file_id, index, min(self.readahead, last - index + 1))
+            if not chunks:
+                return  # Media shorter than expected
+            for data in chunks:
+                offset = index * CHUNK_SIZE
+                yield data[max(start - offset, 0):end - offset + 1]
+                index += 1
+                if index > last:
+                    return
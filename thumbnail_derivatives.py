@@ -0,0 +1,125 @@
+import asyncio
+import glob
+import os
+import re
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # Without Pillow the original thumbnails are served as they are
+    Image = None
+
+import config
+from worker_pool import PoolSaturated, image_pool
+
+# Formats offered next to each other in <picture>: WebP where supported, else JPEG
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+
+# sizes of a grid card thumbnail: full width on phones, else about 360 CSS pixels
+GRID_SIZES = "(max-width: 480px) 100vw, 360px"
+
+_HASHED_NAME_RE = re.compile(r'^([0-9a-f]{32})\.\w+$')
+
+
+def thumbnail_digest(thumbnail_path: Optional[str]) -> Optional[str]:
+    """Content hash naming a stored thumbnail, or None for other (legacy) names"""
+    match = _HASHED_NAME_RE.match(os.path.basename(thumbnail_path or ''))
+    return match.group(1) if match else None
+
+
+def derivative_url(digest: str, width: int, ext: str) -> str:
+    return f"/thumbs/{width}/{digest}.{ext}"
+
+
+def available_widths() -> list:
+    """Widths variants can be requested in ([] without Pillow), for the card-rendering JS"""
+    return sorted(config.THUMBNAIL_WIDTHS) if Image is not None else []
+
+
+def thumbnail_url(thumbnail_path: Optional[str], width: Optional[int] = None) -> str:
+    """JPEG variant of a stored thumbnail (the largest by default), or the original's URL"""
+    digest = thumbnail_digest(thumbnail_path)
+    if digest is None or Image is None:
+        return '/' + (thumbnail_path or '')
+    return derivative_url(digest, width or max(config.THUMBNAIL_WIDTHS), 'jpg')
+
+
+def thumbnail_srcset(thumbnail_path: Optional[str], ext: str = 'jpg') -> str:
+    """srcset of a thumbnail's resized variants ('' if it has none), for templates"""
+    digest = thumbnail_digest(thumbnail_path)
+    if digest is None or Image is None:
+        return ''
+    return ', '.join(f"{derivative_url(digest, width, ext)} {width}w" for width in config.THUMBNAIL_WIDTHS)
+
+
+def render_derivative(source: str, target: str, width: int, image_format: str, quality: int):
+    """Write source scaled down to width (never up) as image_format; runs in the image pool"""
+    with Image.open(source) as image:
+        image = image.convert('RGB')
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        if image_format == 'WEBP':
+            image.save(tmp_path, 'WEBP', quality=quality, method=4)
+        else:
+            image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, target)
+
+
+class ThumbnailDerivatives:
+    """Resized WebP/JPEG variants of the content-addressed thumbnails.
+
+    Originals are never modified. A variant is rendered in the image
+    process pool the first time it is requested and kept under
+    THUMBNAIL_DERIVED_DIR/<width>/<hash>.<ext>; concurrent requests for
+    one variant share the render. Variants are named after the original's
+    content hash, so they can be cached as immutable like the originals.
+    """
+
+    def __init__(self, originals: str = config.THUMBNAILS_DIR, directory: str = config.THUMBNAIL_DERIVED_DIR,
+                 widths=config.THUMBNAIL_WIDTHS, quality: int = config.THUMBNAIL_QUALITY):
+        self.originals = originals
+        self.directory = directory
+        self.widths = set(widths)
+        self.quality = quality
+        self._inflight = {}
+
+    def original(self, digest: str) -> Optional[str]:
+        matches = [path for path in glob.glob(os.path.join(self.originals, f"{digest}.*"))
+                   if not path.endswith('.tmp')]
+        return matches[0] if matches else None
+
+    async def get(self, digest: str, width: int, ext: str) -> Optional[str]:
+        """Path of a variant, rendering it if needed; None if it cannot be made.
+
+        Raises PoolSaturated if the image pool is too busy to render it now.
+        """
+        if Image is None or width not in self.widths or ext not in FORMATS:
+            return None
+        target = os.path.join(self.directory, str(width), f"{digest}.{ext}")
+        if os.path.exists(target):
+            return target
+        key = (digest, width, ext)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render(digest, width, ext, target))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _render(self, digest: str, width: int, ext: str, target: str) -> Optional[str]:
+        source = self.original(digest)
+        if source is None:
+            return None
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            await image_pool.run(render_derivative, source, target, width, FORMATS[ext], self.quality)
+        except PoolSaturated:
+            raise
+        except Exception as e:
+            print(f"Error resizing thumbnail {source} to {width}px {ext}: {e}")
+            return None
+        return target
+
+
+thumbnail_derivatives = ThumbnailDerivatives()
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Optional
+
+import httpx
+
+import config
+from storage import video_source
+from thumbnail_derivatives import thumbnail_digest
+from worker_pool import io_pool
+
+# YouTube answers missing variants with a tiny grey placeholder image
+MIN_THUMBNAIL_BYTES = 1100
+
+
+def _write_file(path: str, content: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _append_line(path: str, line: str):
+    with open(path, 'a') as f:
+        f.write(line + '\n')
+
+
+def _read_index(path: str) -> dict:
+    index = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                index[entry['key']] = entry['path']
+    except FileNotFoundError:
+        pass
+    return index
+
+
+class ThumbnailCache:
+    """Content-addressed thumbnail store under static/thumbnails.
+
+    Images are saved as <sha256 prefix>.jpg, so identical thumbnails are
+    stored once however many videos use them, and the name changes
+    whenever the content does. thumbnail_index.jsonl maps source keys ("yt:<id>",
+    "tg:<file_unique_id>") to stored paths, one appended line per entry, so
+    known thumbnails are never downloaded twice. YouTube fetches share one pooled HTTP client and fall
+    back through config.THUMBNAIL_VARIANTS instead of writing empty files.
+    """
+
+    def __init__(self, directory: str = config.THUMBNAILS_DIR, index_path: str = config.THUMBNAIL_INDEX_FILE,
+                 base_url: str = config.THUMBNAIL_BASE_URL):
+        self.directory = directory
+        self.index_path = index_path
+        self.base_url = base_url.rstrip('/')
+        self.index = _read_index(index_path)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            limits = httpx.Limits(max_connections=config.THUMBNAIL_CONCURRENCY,
+                                  max_keepalive_connections=config.THUMBNAIL_CONCURRENCY)
+            self._client = httpx.AsyncClient(limits=limits, timeout=config.THUMBNAIL_TIMEOUT)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def lookup(self, source_key: str) -> Optional[str]:
+        path = self.index.get(source_key)
+        if path and os.path.exists(path):
+            return path
+        return None
+
+    async def store(self, source_key: str, content: bytes, ext: str = '.jpg') -> str:
+        """Save image bytes under their content hash and remember the source"""
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        path = os.path.join(self.directory, f"{digest}{ext}")
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            await io_pool.run(_write_file, path, content)
+        if self.index.get(source_key) != path:
+            self.index[source_key] = path
+            await io_pool.run(_append_line, self.index_path, json.dumps({'key': source_key, 'path': path}))
+        return path
+
+    async def adopt(self, source_key: str, path: str) -> Optional[str]:
+        """Store a copy of an existing image file; None if it cannot be read"""
+        try:
+            content = await io_pool.run(_read_file, path)
+        except OSError as e:
+            print(f"Error reading thumbnail {path}: {e}")
+            return None
+        return await self.store(source_key, content, os.path.splitext(path)[1] or '.jpg')
+
+    async def fetch_youtube(self, video_id: str) -> Optional[str]:
+        """Path of a YouTube video's thumbnail, downloading it if needed"""
+        source_key = f"yt:{video_id}"
+        path = self.lookup(source_key)
+        if path:
+            return path
+        # Concurrent requests for the same video share one download
+        task = self._inflight.get(source_key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_youtube(source_key, video_id))
+            self._inflight[source_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(source_key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_youtube(self, source_key: str, video_id: str) -> Optional[str]:
+        for variant in config.THUMBNAIL_VARIANTS:
+            url = f"{self.base_url}/vi/{video_id}/{variant}.jpg"
+            try:
+                response = await self.client.get(url)
+            except httpx.HTTPError as e:
+                print(f"Error fetching thumbnail {url}: {e}")
+                continue
+            if response.status_code == 200 and len(response.content) >= MIN_THUMBNAIL_BYTES:
+                return await self.store(source_key, response.content)
+        return None
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+def _legacy_thumbnails(store, directory: str) -> list:
+    """(video_id, source key, path) of videos whose thumbnail is not content-addressed"""
+    legacy = []
+    for video in store.all_videos():
+        path = video.get('thumbnail_path')
+        video_id = video.get('video_id')
+        if not video_id or not path or thumbnail_digest(path):
+            continue
+        if os.path.dirname(os.path.normpath(path)) != os.path.normpath(directory) or not os.path.exists(path):
+            continue
+        source_key = f"yt:{video_id}" if video_source(video) == 'youtube' else f"file:{path}"
+        legacy.append((video_id, source_key, path))
+    return legacy
+
+
+async def adopt_legacy_thumbnails(store, cache: ThumbnailCache = thumbnail_cache):
+    """Move thumbnails saved under their video's name into the content-addressed store.
+
+    Records from before the thumbnail cache point at
+    static/thumbnails/<video_id>.jpg, which gets no resized variants. The
+    images are copied under their content hash and the records rewritten
+    in one store batch; the old files are left for pages still showing them.
+    """
+    changes = {}
+    for video_id, source_key, path in await io_pool.run(_legacy_thumbnails, store, cache.directory):
+        stored = await cache.adopt(source_key, path)
+        if stored:
+            changes[video_id] = {'thumbnail_path': stored}
+    if changes:
+        await io_pool.run(store.update_videos, changes)
+        print(f"Moved {len(changes)} thumbnails into the content-addressed store")
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import mimetypes
+import os
+import shutil
+from typing import List, Optional, Tuple
+
+import config
+from ingest_queue import IngestQueue, RetryableJobError
+from video_store import store
+from worker_pool import io_pool
+
+# Python maps .ts to Qt translation files; HLS segments are MPEG transport streams
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
+MASTER_PLAYLIST = 'master.m3u8'
+
+
+class TranscodeError(Exception):
+    """ffmpeg could not transcode a file; retrying will not help"""
+
+
+def hls_dir(video_id: str) -> str:
+    return os.path.join(config.HLS_DIR, video_id)
+
+
+def hls_url(video_id: str) -> str:
+    return '/' + '/'.join([*config.HLS_DIR.split(os.sep), video_id, MASTER_PLAYLIST])
+
+
+async def _run(args: List[str]) -> bytes:
+    """Run a command, returning its stdout; the process is killed if we are cancelled"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise TranscodeError(f"{args[0]} is not installed")
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        message = stderr.decode(errors='replace').strip().splitlines()
+        raise TranscodeError(f"{os.path.basename(args[0])} failed: {message[-1] if message else process.returncode}")
+    return stdout
+
+
+async def probe(path: str) -> Tuple[Optional[int], bool]:
+    """(height of the first video stream, whether there is an audio stream)"""
+    output = await _run([config.FFPROBE_BIN, '-v', 'error', '-show_entries', 'stream=codec_type,height',
+                         '-of', 'json', path])
+    streams = json.loads(output or b'{}').get('streams', [])
+    heights = [stream['height'] for stream in streams if stream.get('codec_type') == 'video' and stream.get('height')]
+    has_audio = any(stream.get('codec_type') == 'audio' for stream in streams)
+    return (heights[0] if heights else None), has_audio
+
+
+def renditions_for(height: Optional[int]) -> List[Tuple[int, int]]:
+    """Configured (height, kbps) renditions not taller than the source, tallest first"""
+    renditions = sorted(config.TRANSCODE_RENDITIONS, reverse=True)
+    if height:
+        fitting = [rendition for rendition in renditions if rendition[0] <= height]
+        # A source smaller than every rendition still gets the smallest one
+        renditions = fitting or renditions[-1:]
+    return renditions
+
+
+def hls_command(source: str, out_dir: str, renditions: List[Tuple[int, int]], has_audio: bool) -> List[str]:
+    """One ffmpeg run decoding the source once and encoding every rendition.
+
+    Keyframes are forced on segment boundaries so the renditions' segments
+    line up and players can switch bitrate between any two of them.
+    """
+    count = len(renditions)
+    splits = ''.join(f'[v{i}]' for i in range(count))
+    scales = ';'.join(f'[v{i}]scale=-2:{height}[v{i}out]' for i, (height, _) in enumerate(renditions))
+    args = [config.FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-y', '-i', source,
+            '-filter_complex', f'[0:v]split={count}{splits};{scales}',
+            '-threads', str(config.TRANSCODE_THREADS)]
+    for i, (_, kbps) in enumerate(renditions):
+        args += ['-map', f'[v{i}out]', f'-c:v:{i}', 'libx264', '-preset', 'veryfast',
+                 f'-b:v:{i}', f'{kbps}k', f'-maxrate:v:{i}', f'{kbps * 107 // 100}k', f'-bufsize:v:{i}', f'{kbps * 3 // 2}k']
+        if has_audio:
+            args += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', f'{config.TRANSCODE_AUDIO_BITRATE}k', '-ac', '2']
+    segment = config.TRANSCODE_SEGMENT_SECONDS
+    stream_map = ' '.join(f'v:{i},a:{i}' if has_audio else f'v:{i}' for i in range(count))
+    args += ['-force_key_frames', f'expr:gte(t,n_forced*{segment})', '-sc_threshold', '0',
+             '-f', 'hls', '-hls_time', str(segment), '-hls_playlist_type', 'vod',
+             '-hls_segment_filename', os.path.join(out_dir, '%v', 'segment_%04d.ts'),
+             '-master_pl_name', MASTER_PLAYLIST, '-var_stream_map', stream_map,
+             os.path.join(out_dir, '%v', 'index.m3u8')]
+    return args
+
+
+async def transcode(source: str, video_id: str) -> List[Tuple[int, int]]:
+    """Write HLS renditions of a media file under HLS_DIR/<video_id>/.
+
+    The output is built in a temporary directory and moved into place
+    when complete, so the manifest never points at missing segments.
+    Returns the (height, kbps) renditions produced.
+    """
+    height, has_audio = await probe(source)
+    if height is None:
+        raise TranscodeError("No video stream found")
+    renditions = renditions_for(height)
+    target = hls_dir(video_id)
+    tmp_dir = f"{target}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        await _run(hls_command(source, tmp_dir, renditions, has_audio))
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return renditions
+
+
+async def _download_telegram(video: dict) -> str:
+    """Download a Telegram video into TRANSCODE_WORK_DIR and return its path"""
+    from telegram_client import telegram
+    os.makedirs(config.TRANSCODE_WORK_DIR, exist_ok=True)
+    path = os.path.abspath(os.path.join(config.TRANSCODE_WORK_DIR, f"{video['video_id']}.download"))
+    try:
+        await telegram.run(lambda client: client.download_media(video['file_id'], file_name=path))
+    except Exception as e:
+        raise RetryableJobError(f"Download failed: {e}")
+    return path
+
+
+async def run_transcode_job(job: dict, final_attempt: bool) -> dict:
+    """Transcode queue handler: produce HLS renditions of a Telegram video"""
+    video_id = job['params']['video_id']
+    video = store.get_video(video_id)
+    if video is None:
+        raise TranscodeError("Video not found")
+    if video.get('source_type') != 'telegram':
+        raise TranscodeError("Only Telegram videos have media to transcode")
+    source = await _download_telegram(video)
+    try:
+        renditions = await transcode(source, video_id)
+    finally:
+        if os.path.exists(source):
+            os.remove(source)
+    url = hls_url(video_id)
+    await io_pool.run(store.update_video, video_id, hls_url=url, hls_renditions=[height for height, _ in renditions])
+    return {'video_id': video_id, 'hls_url': url}
+
+
+async def submit_transcode(video_id: str, user_id: str) -> dict:
+    """Queue a transcode of a video, or return the one already in flight"""
+    return await transcode_queue.submit('transcode', user_id, video_id, video_id=video_id)
+
+
+# Jobs run in the leader worker, TRANSCODE_WORKERS ffmpeg processes at a time
+transcode_queue = IngestQueue(path=config.TRANSCODE_JOBS_FILE, workers=config.TRANSCODE_WORKERS)
@@ -0,0 +1,494 @@
+import asyncio
+import base64
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import config
+import storage
+from folder_tree import FolderTree
+from search_index import SearchIndex, video_terms
+from storage import video_folder, video_source
+from worker_pool import io_pool
+
+
+def video_sort_key(video: dict, video_id: str) -> tuple:
+    """Listing order key; pages are served newest first, ties broken by ID"""
+    return (str(video.get('added_time', '')), video_id)
+
+
+# Search scope of channel videos: they have no owner and every user can see them
+CHANNEL_SCOPE = ('channel',)
+
+
+def search_scope(video: dict):
+    """Search index a video belongs to: its owner's, or the shared channel one"""
+    return CHANNEL_SCOPE if video_source(video) == 'telegram' else video.get('user_id')
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Parse a listing cursor, raising ValueError if it is malformed"""
+    try:
+        added_time, video_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return (str(added_time), str(video_id))
+
+
+class VideoStore:
+    """In-memory video and folder catalog with secondary indexes.
+
+    The catalog is read from the storage backend once by load() and then
+    served from memory. Every mutation is handed to the backend as one batch
+    of operations before it is applied, so multi-record changes (renames,
+    bulk deletes) are stored all-or-nothing. Operations always carry the
+    full record.
+
+    With several worker processes, writes hold the backend's cross-process
+    lock and first catch up with the backend's catalog generation, so
+    read-modify-write updates never work from stale records. sync() does
+    the same for readers and is called periodically. The cross-process
+    lock is always taken first and self.lock only around changes to the
+    in-memory collections, so readers never wait on another process or
+    on a disk write.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else storage.backend
+        self.lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._videos: Dict[str, dict] = {}
+        self._folders: Dict[str, dict] = {}
+        self._by_user: Dict[str, set] = {}
+        self._by_source: Dict[str, set] = {}
+        self._by_file_id: Dict[str, set] = {}
+        self._folders_by_user: Dict[str, set] = {}
+        self._trees: Dict[str, FolderTree] = {}
+        self._recent_by_user: Dict[str, list] = {}
+        self._search: Dict[str, SearchIndex] = {}
+        # Per-user data versions, drawn from one counter so they never repeat
+        self._version_counter = itertools.count(1)
+        self._versions: Dict[str, int] = {}
+        self._base_version = 0  # Version of users with no change since the last load
+        self.generation = 0  # Backend catalog generation reflected in memory
+
+    # Loading / import / export
+
+    def _reset(self):
+        self._videos = {}
+        self._folders = {}
+        self._by_user = {}
+        self._by_source = {}
+        self._by_file_id = {}
+        self._folders_by_user = {}
+        self._trees = {}
+        self._recent_by_user = {}
+        self._search = {}
+        self._versions = {}
+        self._base_version = next(self._version_counter)
+
+    def load(self):
+        """Load the catalog from the storage backend and build the indexes"""
+        with self.backend.locked():
+            videos, folders = self.backend.load_catalog()
+            generation = self.backend.generation('catalog')
+            with self.lock:
+                self.generation = generation
+                self._reset()
+                for video_id, video in videos.items():
+                    self._apply({'op': 'put_video', 'key': video_id, 'value': video})
+                for path, folder in folders.items():
+                    self._apply({'op': 'put_folder', 'key': path, 'value': folder})
+
+    def import_data(self, videos: dict, folders: dict):
+        """Replace the catalog with the given video and folder dicts"""
+        with self._writing():
+            ops = [{'op': 'del_video', 'key': video_id} for video_id in self._videos]
+            ops += [{'op': 'del_folder', 'key': path} for path in self._folders]
+            ops += [{'op': 'put_video', 'key': video_id, 'value': video} for video_id, video in videos.items()]
+            ops += [{'op': 'put_folder', 'key': path, 'value': folder} for path, folder in folders.items()]
+            self._commit(ops)
+        self.compact()
+
+    def export_videos(self) -> dict:
+        """Copy of the video collection in the video_db.json layout"""
+        with self.lock:
+            return {video_id: dict(video) for video_id, video in self._videos.items()}
+
+    def export_folders(self) -> dict:
+        """Copy of the folder collection in the folder_db.json layout"""
+        with self.lock:
+            return {path: dict(folder) for path, folder in self._folders.items()}
+
+    # Index maintenance
+
+    @staticmethod
+    def _add_to(index: Dict[str, set], key, item):
+        index.setdefault(key, set()).add(item)
+
+    @staticmethod
+    def _remove_from(index: Dict[str, set], key, item):
+        items = index.get(key)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del index[key]
+
+    def _tree(self, user_id) -> FolderTree:
+        tree = self._trees.get(user_id)
+        if tree is None:
+            tree = self._trees[user_id] = FolderTree()
+        return tree
+
+    def _index_video(self, video_id: str, video: dict):
+        self._add_to(self._by_user, video.get('user_id'), video_id)
+        self._add_to(self._by_source, video_source(video), video_id)
+        if video.get('file_id'):
+            self._add_to(self._by_file_id, video['file_id'], video_id)
+        if video_folder(video):
+            self._tree(video.get('user_id')).add_video(video_folder(video), video_id, video_sort_key(video, video_id))
+        bisect.insort(self._recent_by_user.setdefault(video.get('user_id'), []), video_sort_key(video, video_id))
+        search = self._search.setdefault(search_scope(video), SearchIndex())
+        search.add(video_id, video_terms(video, video_folder(video)))
+
+    def _unindex_video(self, video_id: str, video: dict):
+        self._remove_from(self._by_user, video.get('user_id'), video_id)
+        self._remove_from(self._by_source, video_source(video), video_id)
+        if video.get('file_id'):
+            self._remove_from(self._by_file_id, video['file_id'], video_id)
+        if video_folder(video):
+            self._tree(video.get('user_id')).remove_video(video_folder(video), video_id,
+                                                          video_sort_key(video, video_id))
+        recent = self._recent_by_user.get(video.get('user_id'))
+        if recent is not None:
+            key = video_sort_key(video, video_id)
+            index = bisect.bisect_left(recent, key)
+            if index < len(recent) and recent[index] == key:
+                del recent[index]
+        search = self._search.get(search_scope(video))
+        if search is not None:
+            search.remove(video_id)
+
+    def _index_folder(self, path: str, folder: dict):
+        self._add_to(self._folders_by_user, folder.get('user_id'), path)
+        self._tree(folder.get('user_id')).add_folder(path)
+
+    def _unindex_folder(self, path: str, folder: dict):
+        self._remove_from(self._folders_by_user, folder.get('user_id'), path)
+        self._tree(folder.get('user_id')).remove_folder(path)
+
+    # Operations and the write-ahead log
+
+    def _changed(self, *records: Optional[dict]):
+        for record in records:
+            if record is not None:
+                self._versions[record.get('user_id')] = next(self._version_counter)
+
+    def _apply(self, op: dict):
+        """Apply one log operation to the in-memory collections"""
+        kind = op['op']
+        key = op['key']
+        if kind == 'put_video':
+            old = self._videos.get(key)
+            if old is not None:
+                self._unindex_video(key, old)
+            self._videos[key] = op['value']
+            self._index_video(key, op['value'])
+            self._changed(old, op['value'])
+        elif kind == 'del_video':
+            old = self._videos.pop(key, None)
+            if old is not None:
+                self._unindex_video(key, old)
+                self._changed(old)
+        elif kind == 'put_folder':
+            old = self._folders.get(key)
+            if old is not None:
+                self._unindex_folder(key, old)
+            self._folders[key] = op['value']
+            self._index_folder(key, op['value'])
+            self._changed(old, op['value'])
+        elif kind == 'del_folder':
+            old = self._folders.pop(key, None)
+            if old is not None:
+                self._unindex_folder(key, old)
+                self._changed(old)
+
+    def sync(self):
+        """Catch up with catalog changes made by other worker processes"""
+        if self.backend.generation('catalog') == self.generation:
+            return
+        with self.backend.locked():
+            self._sync_locked()
+
+    def _sync_locked(self):
+        """Catch up with the backend; called with its cross-process lock held"""
+        generation = self.backend.generation('catalog')
+        if generation == self.generation:
+            return
+        ops = self.backend.changes_since(self.generation)
+        if ops is None:
+            self.load()
+            return
+        with self.lock:
+            for op in ops:
+                self._apply(op)
+            self.generation = generation
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Hold the cross-process lock with the catalog up to date"""
+        with self.backend.locked():
+            self._sync_locked()
+            yield
+
+    def _commit(self, ops: List[dict]):
+        """Store operations as one batch in the backend, then apply them"""
+        if not ops:
+            return
+        with self._writing():
+            generation = self.backend.append(ops)
+            with self.lock:
+                for op in ops:
+                    self._apply(op)
+                self.generation = generation
+
+    def compact(self):
+        """Let the backend fold its write log into fresh snapshots.
+
+        The lock is only held to copy the collections and start a new log;
+        the snapshots are written afterwards while writers keep appending.
+        Backends without a log of their own have nothing to do.
+        """
+        with self._compact_lock:
+            with self._writing():
+                if not self.backend.begin_compaction():
+                    return
+                videos = self.export_videos()
+                folders = self.export_folders()
+            self.backend.finish_compaction(videos, folders)
+
+    def needs_compaction(self, interval: float, threshold: int) -> bool:
+        return self.backend.needs_compaction(interval, threshold)
+
+    def close(self):
+        with self.lock:
+            self.backend.close()
+
+    # Video reads
+
+    def get_video(self, video_id: str) -> Optional[dict]:
+        return self._videos.get(video_id)
+
+    def data_version(self, user_id: str) -> int:
+        """Number that changes whenever one of the user's videos or folders does"""
+        return self._versions.get(user_id, self._base_version)
+
+    def video_by_file_id(self, file_id: str) -> Optional[dict]:
+        """A video stored from a Telegram file (copies share it), or None"""
+        with self.lock:
+            video_ids = self._by_file_id.get(file_id)
+            return self._videos[next(iter(video_ids))] if video_ids else None
+
+    def has_video(self, video_id: str) -> bool:
+        return video_id in self._videos
+
+    def video_count(self) -> int:
+        return len(self._videos)
+
+    def all_videos(self) -> List[dict]:
+        with self.lock:
+            return list(self._videos.values())
+
+    def _collect(self, ids: Iterable[str]) -> List[dict]:
+        return [self._videos[video_id] for video_id in ids if video_id in self._videos]
+
+    def videos_for_user(self, user_id: str) -> List[dict]:
+        with self.lock:
+            return self._collect(self._by_user.get(user_id, ()))
+
+    def videos_by_source(self, source_type: str) -> List[dict]:
+        with self.lock:
+            return self._collect(self._by_source.get(source_type, ()))
+
+    # Folder reads
+
+    def get_folder(self, path: str) -> Optional[dict]:
+        return self._folders.get(path)
+
+    def has_folder(self, path: str) -> bool:
+        return path in self._folders
+
+    def folder_count(self) -> int:
+        return len(self._folders)
+
+    def folders_for_user(self, user_id: str) -> Dict[str, dict]:
+        with self.lock:
+            return {path: self._folders[path] for path in self._folders_by_user.get(user_id, ())}
+
+    def page_for_user(self, user_id: str, limit: int, cursor: Optional[str] = None,
+                      folder: Optional[str] = None, recursive: bool = True):
+        """One page of a user's videos, newest first, as (videos, next_cursor).
+
+        Pages are keyset based: the cursor encodes the (added_time, video_id)
+        of the last video returned, so pages stay stable while videos are
+        added. Whole-library pages come straight from the per-user sorted
+        index; folder pages merge the sorted keys of the folder's subtree.
+        """
+        with self.lock:
+            if folder is not None:
+                newest = self._tree(user_id).newest_keys(folder, recursive, decode_cursor(cursor) if cursor else None)
+                keys = list(itertools.islice(newest, limit + 1))
+                page = [self._videos[video_id] for _, video_id in keys[:limit]]
+                next_cursor = encode_cursor(keys[limit - 1]) if len(keys) > limit else None
+                return page, next_cursor
+            keys = self._recent_by_user.get(user_id, [])
+            end = bisect.bisect_left(keys, decode_cursor(cursor)) if cursor else len(keys)
+            start = max(end - limit, 0)
+            page = [self._videos[video_id] for _, video_id in reversed(keys[start:end])]
+            next_cursor = encode_cursor(keys[start]) if start > 0 else None
+            return page, next_cursor
+
+    def search(self, user_id: str, query: str, limit: int, folder: Optional[str] = None):
+        """Best matches for a query among the videos a user can see, as (videos, total).
+
+        Every query term must prefix-match a token of the title, folder
+        path, category or description. Results are ranked by score, then
+        newest first. Channel videos are searched along with the user's
+        own; folder restricts results to that folder of the user's library.
+        """
+        with self.lock:
+            scopes = [user_id] if folder is not None else [user_id, CHANNEL_SCOPE]
+            matches = {}
+            for scope in scopes:
+                if scope in self._search:
+                    matches.update(self._search[scope].search(query))
+            if folder is not None:
+                in_folder = self._tree(user_id).video_ids(folder)
+                matches = {video_id: matches[video_id] for video_id in in_folder if video_id in matches}
+            best = self._rank(matches, limit, [user_id, None] if folder is None else [user_id])
+            return [self._videos[video_id] for video_id in best], len(matches)
+
+    def _rank(self, matches: Dict[str, int], limit: int, owners: list) -> List[str]:
+        """IDs of the best scoring matches, ties broken newest first.
+
+        Matches scoring above the last place score are few and sorted
+        directly. A large tie at that score (common for short queries) is
+        resolved by walking the owners' recency indexes newest first, so
+        no sort key is built for most of the matches.
+        """
+        if not matches:
+            return []
+        cutoff = heapq.nlargest(limit, matches.values())[-1]
+        above = [video_id for video_id, score in matches.items() if score > cutoff]
+        above.sort(key=lambda video_id: (matches[video_id], video_sort_key(self._videos[video_id], video_id)),
+                   reverse=True)
+        wanted = limit - len(above)
+        tied = [video_id for video_id, score in matches.items() if score == cutoff]
+        if len(tied) <= 4 * limit:
+            tied.sort(key=lambda video_id: video_sort_key(self._videos[video_id], video_id), reverse=True)
+            return above + tied[:wanted]
+        tied = set(tied)
+        newest = heapq.merge(*(reversed(self._recent_by_user.get(owner, [])) for owner in owners), reverse=True)
+        picked = itertools.islice((video_id for _, video_id in newest if video_id in tied), wanted)
+        return above + list(picked)
+
+    def subfolders(self, user_id: str, path: str) -> Dict[str, str]:
+        """Immediate subfolders of a user's folder as {name: full path}"""
+        with self.lock:
+            return self._tree(user_id).children(path)
+
+    def folder_hierarchy(self, user_id: str) -> dict:
+        """Nested folder hierarchy of a user, with direct and recursive counts"""
+        with self.lock:
+            return self._tree(user_id).to_hierarchy()
+
+    def folder_list(self, user_id: str) -> List[dict]:
+        """Flat depth-first folder list of a user"""
+        with self.lock:
+            return self._tree(user_id).flatten()
+
+    # Video writes
+
+    def put_video(self, video_id: str, video: dict):
+        """Insert or replace a single video record"""
+        self._commit([{'op': 'put_video', 'key': video_id, 'value': video}])
+
+    def put_videos(self, videos: Dict[str, dict]):
+        """Insert or replace several video records as one log record"""
+        self._commit([{'op': 'put_video', 'key': video_id, 'value': video}
+                      for video_id, video in videos.items()])
+
+    def update_video(self, video_id: str, **fields) -> Optional[dict]:
+        """Update fields of an existing video, returning the new record"""
+        with self._writing():
+            video = self._videos.get(video_id)
+            if video is None:
+                return None
+            updated = dict(video, **fields)
+            self._commit([{'op': 'put_video', 'key': video_id, 'value': updated}])
+            return updated
+
+    def update_videos(self, changes: Dict[str, dict]):
+        """Update fields of several existing videos as one log record"""
+        with self._writing():
+            self._commit([{'op': 'put_video', 'key': video_id, 'value': dict(self._videos[video_id], **fields)}
+                          for video_id, fields in changes.items() if video_id in self._videos])
+
+    def add_views(self, counts: Dict[str, int]):
+        """Add view counts to several videos as one log record"""
+        with self._writing():
+            ops = []
+            for video_id, count in counts.items():
+                video = self._videos.get(video_id)
+                if video is not None:
+                    updated = dict(video, views_count=video.get('views_count', 0) + count)
+                    ops.append({'op': 'put_video', 'key': video_id, 'value': updated})
+            self._commit(ops)
+
+    def delete_videos(self, video_ids: Iterable[str]) -> int:
+        """Delete video records, returning how many existed"""
+        with self._writing():
+            ops = [{'op': 'del_video', 'key': video_id} for video_id in video_ids if video_id in self._videos]
+            self._commit(ops)
+            return len(ops)
+
+    # Folder writes
+
+    def put_folder(self, path: str, folder: dict):
+        self._commit([{'op': 'put_folder', 'key': path, 'value': folder}])
+
+    def rename_folder(self, old_path: str, new_path: str, folder: dict):
+        """Move a folder record to a new key as one log record"""
+        self._commit([
+            {'op': 'del_folder', 'key': old_path},
+            {'op': 'put_folder', 'key': new_path, 'value': folder},
+        ])
+
+    def delete_folders(self, paths: Iterable[str]) -> int:
+        with self._writing():
+            ops = [{'op': 'del_folder', 'key': path} for path in paths if path in self._folders]
+            self._commit(ops)
+            return len(ops)
+
+
+async def run_compactor(store: VideoStore, interval: float = config.STORE_COMPACT_INTERVAL,
+                        threshold: int = config.STORE_COMPACT_THRESHOLD, poll: float = 5):
+    """Background task compacting the store log by age or size"""
+    while True:
+        await asyncio.sleep(poll)
+        if store.needs_compaction(interval, threshold):
+            try:
+                await io_pool.run(store.compact)
+            except Exception as e:
+                print(f"Error compacting video store: {e}")
+
+
+store = VideoStore()
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from typing import Dict, List
+
+import config
+from video_store import VideoStore
+from worker_pool import PoolSaturated, io_pool
+
+
+class ViewCounter:
+    """Buffers view increments and writes them to the store in batches.
+
+    Watching a video only bumps an in-memory counter. Pending counts are
+    committed to the store as one log record once flush_threshold views
+    have accumulated (flush_due) or when the periodic flusher runs; flush()
+    blocks on the store write, so callers on the event loop run it in the
+    io pool. Reads go through views()/with_views()/total_views(), which add
+    the pending counts, and those of a batch being written, on top of the
+    stored ones so callers always see up to date numbers.
+    """
+
+    def __init__(self, store: VideoStore, flush_threshold: int = config.VIEW_FLUSH_THRESHOLD):
+        self.store = store
+        self.flush_threshold = flush_threshold
+        self.lock = threading.RLock()
+        self._pending: Dict[str, int] = {}
+        self._pending_total = 0
+        self._flushing: Dict[str, int] = {}  # Batch being written to the store
+        self._flush_lock = threading.Lock()
+
+    @property
+    def flush_due(self) -> bool:
+        return self._pending_total >= self.flush_threshold
+
+    def increment(self, video_id: str) -> int:
+        """Count one view and return the video's current total"""
+        with self.lock:
+            self._pending[video_id] = self._pending.get(video_id, 0) + 1
+            self._pending_total += 1
+            return self.views(video_id)
+
+    def _unstored(self, video_id: str) -> int:
+        return self._pending.get(video_id, 0) + self._flushing.get(video_id, 0)
+
+    def views(self, video_id: str) -> int:
+        with self.lock:
+            video = self.store.get_video(video_id) or {}
+            return video.get('views_count', 0) + self._unstored(video_id)
+
+    def with_views(self, videos: List[dict]) -> List[dict]:
+        """Overlay pending counts on a list of records without mutating them"""
+        with self.lock:
+            if not self._pending and not self._flushing:
+                return videos
+            return [dict(video, views_count=video.get('views_count', 0) + self._unstored(video['video_id']))
+                    if self._unstored(video.get('video_id')) else video
+                    for video in videos]
+
+    def total_views(self) -> int:
+        with self.lock:
+            unstored = self._pending_total + sum(self._flushing.values())
+            return sum(video.get('views_count', 0) for video in self.store.all_videos()) + unstored
+
+    def flush(self):
+        """Write the pending counts to the store (blocking)"""
+        with self._flush_lock:
+            with self.lock:
+                if not self._pending:
+                    return
+                # Readers keep adding the batch until it is dropped below,
+                # just after the store has applied it
+                self._flushing, self._pending = self._pending, {}
+                self._pending_total = 0
+            try:
+                self.store.add_views(self._flushing)
+            except BaseException:
+                with self.lock:
+                    # Not written: the views are pending again
+                    for video_id, count in self._flushing.items():
+                        self._pending[video_id] = self._pending.get(video_id, 0) + count
+                        self._pending_total += count
+                    self._flushing = {}
+                raise
+            with self.lock:
+                self._flushing = {}
+
+
+async def run_view_flusher(counter: ViewCounter, interval: float = config.VIEW_FLUSH_INTERVAL):
+    """Background task flushing buffered views every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await io_pool.run(counter.flush)
+        except PoolSaturated:
+            pass
+        except Exception as e:
+            print(f"Error flushing view counts: {e}")
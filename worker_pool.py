@@ -0,0 +1,76 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import config
+
+
+class PoolSaturated(Exception):
+    """Raised when a pool already has as many jobs as it accepts"""
+
+    def __init__(self, pool_name: str):
+        super().__init__(f"Worker pool '{pool_name}' is saturated")
+        self.pool_name = pool_name
+
+
+class WorkerPool:
+    """Bounded thread pool for blocking calls made from async handlers.
+
+    At most max_workers jobs run at once and at most max_queue more wait
+    for a thread; anything beyond that raises PoolSaturated straight away
+    instead of piling up behind slow work, which the app turns into a 503.
+    The counters are only touched from the event loop thread.
+
+    With processes=True the jobs run in worker processes instead, for
+    CPU-bound work that would otherwise hold the GIL; fn and its arguments
+    must then be picklable (module-level functions and plain data).
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int, processes: bool = False):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        if processes:
+            # Forked, so children do not re-import the app (spawn would run
+            # app.py again in each); warm_up() forks them while idle
+            self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                mp_context=multiprocessing.get_context("fork"))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self.pending = 0
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_workers + self.max_queue
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the pool and await its result"""
+        if self.saturated:
+            raise PoolSaturated(self.name)
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def warm_up(self):
+        """Start the workers now instead of on the first job"""
+        self.executor.submit(int).result()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "queue_limit": self.max_queue,
+            "running": min(self.pending, self.max_workers),
+            "queued": max(self.pending - self.max_workers, 0),
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+extract_pool = WorkerPool("extract", config.EXTRACT_POOL_SIZE, config.EXTRACT_QUEUE_LIMIT)
+io_pool = WorkerPool("io", config.IO_POOL_SIZE, config.IO_QUEUE_LIMIT)
+image_pool = WorkerPool("image", config.IMAGE_POOL_SIZE, config.IMAGE_QUEUE_LIMIT, processes=True)